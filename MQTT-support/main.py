@@ -31,7 +31,7 @@ import random
 from math import floor
 
 #import time
-from time import sleep, mktime, localtime
+from time import sleep, mktime, localtime, ticks_ms, ticks_diff
 
 # Import pin-control
 from machine import Pin, Timer
@@ -49,6 +49,10 @@ mqtt_server = 'test.mosquitto.org'
 client_id = 'PicoW'
 user_t = 'rw'
 password_t = 'readwrite'
+# Connect to broker over TLS (port 8883)
+mqtt_ssl = False
+# QoS of published channel states, 1 or 2 for delivery guarantee
+mqtt_qos = 0
 channel1_topic = '#'
 channel2_topic = 'hello'
 channel3_topic = 'hello'
@@ -69,6 +73,27 @@ channel6_mode = 'GPIO'
 channel7_mode = 'GPIO'
 channel8_mode = 'GPIO'
 
+# Push mode (experimental)
+# Device subscribes to its own topic ({} is replaced with device mac). Any message is a notification
+# that controls have changed on server, and controls are then requested from server. Pushed control
+# JSON is used directly only if mqtt_push_json is set and broker connection uses TLS and credentials,
+# otherwise anyone who can publish to the topic could switch relays.
+# While push session is connected, HTTP-requests are done only with long interval as a fallback.
+mqtt_push = False
+mqtt_push_topic = 'porssari/{}/controls'
+mqtt_push_json = False
+push_poll_interval = 900
+
+# MQTT session is kept open, broker is pinged to keep it alive (seconds)
+mqtt_keepalive = 60
+
+# Link telemetry (experimental)
+# Wifi quality counters and request round-trip times from connectionmanager are published
+# as JSON to device's own topic every telemetry_interval seconds
+mqtt_telemetry = False
+mqtt_telemetry_topic = 'porssari/{}/telemetry'
+telemetry_interval = 300
+
 
 # Real time clock
 rtc = machine.RTC()
@@ -77,6 +102,8 @@ rtc = machine.RTC()
 programTimer = Timer()
 controlTimer = Timer()
 requestTimer = Timer()
+mqttTimer = Timer()
+connectionTimer = Timer()
 
 # Onboard led
 onboard = Pin("LED", Pin.OUT, value=0)
@@ -162,9 +189,6 @@ except:
         print("Error with device MAC, rebooting..")
         machine.reset()
 
-# Get wifi connection (Returns wlan_sta or wlan_ap)
-wifi = connectionmanager.get_connection(profiles)
-
 # Program state variables
 lastRequest = 0
 hoursLeftOnJson = 0
@@ -176,16 +200,130 @@ bootTimestampSynced = False
 # Empty list for webserver until first request is succeeded
 controlsJson = {}
 
-#MQTT connect
+# MQTT session state (experimental)
+mqttClient = None
+mqttSession = None
+mqttMessage = None
+mqttLastPing = 0
+mqttPublished = {}
+mqttTelemetrySent = None
+
+# Pushed control JSON is accepted only over authenticated TLS connection
+pushJson = mqtt_push_json and mqtt_ssl and bool(user_t) and bool(password_t)
+if mqtt_push_json and not pushJson:
+    print('Pushed control JSON needs TLS and credentials, push messages are used only as notifications')
+
+#MQTT connect, session is kept open between controls. Client object is reused on reconnect, so
+#unacknowledged QoS 1/2 messages are sent again if broker has kept the session.
 def mqttConnect():
-    client = MQTTClient(client_id, mqtt_server, user=user_t, password=password_t, keepalive=10)
-    client.connect()
+    global mqttClient,mqttSession,mqttLastPing,mqttPublished
+    if mqttSession is None:
+        mqttSession = MQTTClient('{}-{}'.format(client_id, mac), mqtt_server, user=user_t, password=password_t, keepalive=mqtt_keepalive, ssl=mqtt_ssl, ssl_params={'server_hostname': mqtt_server})
+        mqttSession.set_callback(mqttReceived)
+    client = mqttSession
+    try:
+        client.connect(clean_session=not (mqtt_push or mqtt_qos))
+        if mqtt_push:
+            client.subscribe(mqtt_push_topic.format(mac), qos=1)
+    except:
+        if client.sock:
+            client.sock.close()
+        raise
+    mqttClient = client
+    mqttLastPing = ticks_ms()
+    
+    # Channel states are published again after reconnect
+    mqttPublished = {}
     print('           Connected to %s MQTT Broker'%(mqtt_server))
-    return client
+
+def mqttDisconnect():
+    global mqttClient,getControlsTimerArmed
+    try:
+        mqttClient.sock.close()
+    except:
+        pass
+    mqttClient = None
+    
+    # Back to normal request interval until push session is connected again
+    if mqtt_push:
+        requestTimer.deinit()
+        getControlsTimerArmed = False
+
+# Publish message if it differs from the last one published to the topic.
+# Returns True if published, False if not changed and None if there is no connection.
+def mqttPublish(topic, msg):
+    if mqttPublished.get(topic) == msg:
+        return False
+    if not mqttClient:
+        return None
+    try:
+        mqttClient.publish(topic, msg=msg, qos=mqtt_qos)
+    except Exception as e:
+        print('           MQTT connection lost ({})'.format(e))
+        mqttDisconnect()
+        return None
+    mqttPublished[topic] = msg
+    return True
+    
+def mqttTelemetry():
+    global mqttTelemetrySent
+    if mqttTelemetrySent is not None and ticks_diff(ticks_ms(), mqttTelemetrySent) < telemetry_interval * 1000:
+        return
+    if mqttPublish(mqtt_telemetry_topic.format(mac), json.dumps(connectionmanager.telemetry())) is not None:
+        mqttTelemetrySent = ticks_ms()
+
+def mqttReceived(topic, msg):
+    global mqttMessage
+    mqttMessage = msg
+
+# Keep MQTT session alive and handle pushed messages, called every second by mqttTimer
+def mqttCheck(Timer):
+    global mqttMessage,mqttLastPing
+    if not mqttClient:
+        return
+    
+    try:
+        mqttClient.check_msg()
+        if ticks_diff(ticks_ms(), mqttLastPing) > mqtt_keepalive * 500:
+            mqttClient.ping()
+            mqttLastPing = ticks_ms()
+    except Exception as e:
+        time = rtc.datetime()
+        print("\n[{:02d}:{:02d}:{:02d}]".format(time[4],time[5],time[6]),end=" ")
+        print('MQTT connection lost ({})'.format(e))
+        mqttDisconnect()
+        return
+
+    # Broker has not answered pings for 1.5 keepalive periods
+    if ticks_diff(ticks_ms(), mqttClient.last_pingresp) > mqtt_keepalive * 1500:
+        time = rtc.datetime()
+        print("\n[{:02d}:{:02d}:{:02d}]".format(time[4],time[5],time[6]),end=" ")
+        print('MQTT broker not responding')
+        mqttDisconnect()
+        return
+        
+    if mqttMessage is None:
+        return
+    msg = mqttMessage
+    mqttMessage = None
+    
+    # Use pushed control JSON if it is allowed and newer than current one, otherwise get controls from server
+    if pushJson and rtcSynced and msg[:1] == b'{':
+        try:
+            newJson = json.loads(msg)
+            if int(newJson['Metadata']['Timestamp']) > lastRequest:
+                time = rtc.datetime()
+                print("\n[{:02d}:{:02d}:{:02d}]".format(time[4],time[5],time[6]),end=" ")
+                print('Control data received from push session')
+                useControls(newJson, False)
+            return
+        except (ValueError, KeyError):
+            print('           Pushed control data not valid')
+    getControls()
 
     
 def updateStatus():
-    global doControlsTimerArmed,hoursLeftOnJson,controlsJson,wifi
+    global doControlsTimerArmed,hoursLeftOnJson,controlsJson
     
     # Micropython health checks
     # Collect garbages
@@ -196,16 +334,11 @@ def updateStatus():
     print("\n[{:02d}:{:02d}:{:02d}]".format(time[4],time[5],time[6]),end=" ")
     print("Memory: free:{}, alloc:{}".format(gc.mem_free(), gc.mem_alloc()))
            
-    # If device is not connected to wifi-network, try to connect       
+    # Wifi-connection is handled in background by connection manager
     if not connectionmanager.wlan_sta.isconnected():
         time = rtc.datetime() 
         print("[{:02d}:{:02d}:{:02d}]".format(time[4],time[5],time[6]),end=" ")
-        print("No internet connection, trying to connect")
-        
-        wifi = connectionmanager.get_connection(profiles)
-        if not connectionmanager.wlan_sta.isconnected():
-            print("[{:02d}:{:02d}:{:02d}]".format(time[4],time[5],time[6]),end=" ")
-            print("Could not connect")
+        print("No internet connection, connection state: {}".format(connectionmanager.STATE_NAMES[connectionmanager.state]))
             
     else:
         time = rtc.datetime() 
@@ -244,8 +377,9 @@ def updateStatus():
 def getControls():
     global controlsJson,lastRequest,rtcSynced
     
-    # If controller is in ap-mode there is no internet connection, not worth trying to get new JSON..
-    if connectionmanager.wlan_ap.isconnected():
+    # If wifi is not connected (access point only) there is no internet connection, not worth trying to get new JSON..
+    if not connectionmanager.wlan_sta.isconnected():
+        time = rtc.datetime() 
         print("\n[{:02d}:{:02d}:{:02d}]".format(time[4],time[5],time[6]),end=" ")
         print('No internet connection, JSON request not possible.')
         return
@@ -264,7 +398,8 @@ def getControls():
        
     print(urlToCall)
     
-    # JSON-request 
+    # JSON-request, round-trip time until response headers is recorded for telemetry
+    requestStart = ticks_ms()
     try:
         try:
             resp = requests.get(urlToCall, timeout=8, json=True)
@@ -272,48 +407,19 @@ def getControls():
             time = rtc.datetime() 
             print("[{:02d}:{:02d}:{:02d}]".format(time[4],time[5],time[6]),end=" ")
             print("Error! Trying fallback-url (",end="")
-            urlToCall = "{}?device_mac={}&last_request={}".format(fallbackUrl,deviceMac,lastRequest)
+            urlToCall = "{}?device_mac={}&last_request={}&client={}".format(fallbackUrl,mac,lastRequest,VERSION)
             print("{})".format(urlToCall))
             resp = requests.get(urlToCall, timeout=8, json=True)
         
+        connectionmanager.record_request(ticks_diff(ticks_ms(), requestStart))
+        requestStart = None
         if resp.status_code == 200:
-            controlsJson = resp.json()
+            newJson = resp.json()
             resp.close()
             time = rtc.datetime() 
             print("\n[{:02d}:{:02d}:{:02d}]".format(time[4],time[5],time[6]),end=" ")
             print('Control data requested succesfully. Code 200.')
-            
-            # Check RTC
-            try:
-                # Check if RTC-time is +- 1 second from json-timestamp. If difference is more, update RTC-time from current json.
-                timeUnix = int(mktime(localtime()))
-                timeWithOffset = int(controlsJson['Metadata']['Timestamp']) + int(controlsJson['Metadata']['Timestamp_offset'])
-                diff = timeWithOffset - timeUnix
-                if diff not in range(-1, 2):
-                    time = rtc.datetime() 
-                    print("\n[{:02d}:{:02d}:{:02d}]".format(time[4],time[5],time[6]),end=" ")
-                    print("RTC out of range (JSON: {}, Local: {}), updating from host server...".format(timeWithOffset,timeUnix),end=" ")
-                    rtcSynced = syncClock(timeWithOffset,diff)
-                    
-                else:
-                    rtcSynced = True
-                time = rtc.datetime() 
-                print("[{:02d}:{:02d}:{:02d}]".format(time[4],time[5],time[6]),end=" ")
-                    
-            # General error expection, need for a better handling...
-            except:
-                rtcSynced = False
-                
-            print("RTC synced: {}".format(rtcSynced))
-            
-            # Do controls right after new JSON
-            deviceChannels = int(controlsJson['Metadata']['Channels'])
-            lastRequest = int(controlsJson['Metadata']['Timestamp'])
-            time = rtc.datetime() 
-            print("[{:02d}:{:02d}:{:02d}]".format(time[4],time[5],time[6]),end=" ")
-            print('Channels to control: {}'.format(deviceChannels))
-            updateStatus()
-            doControls(False)
+            useControls(newJson, True)
             
         elif resp.status_code == 400:
             time = rtc.datetime() 
@@ -346,6 +452,47 @@ def getControls():
         time = rtc.datetime() 
         print("[{:02d}:{:02d}:{:02d}]".format(time[4],time[5],time[6]),end=" ")
         print("ERROR!")
+        if requestStart is not None:
+            connectionmanager.record_request(None)
+
+
+# Take new control JSON in use. RTC is checked only from JSON straight from the server.
+def useControls(newJson, checkRtc):
+    global controlsJson,lastRequest,rtcSynced
+    controlsJson = newJson
+    
+    # Check RTC
+    if checkRtc:
+        try:
+            # Check if RTC-time is +- 1 second from json-timestamp. If difference is more, update RTC-time from current json.
+            timeUnix = int(mktime(localtime()))
+            timeWithOffset = int(controlsJson['Metadata']['Timestamp']) + int(controlsJson['Metadata']['Timestamp_offset'])
+            diff = timeWithOffset - timeUnix
+            if diff not in range(-1, 2):
+                time = rtc.datetime() 
+                print("\n[{:02d}:{:02d}:{:02d}]".format(time[4],time[5],time[6]),end=" ")
+                print("RTC out of range (JSON: {}, Local: {}), updating from host server...".format(timeWithOffset,timeUnix),end=" ")
+                rtcSynced = syncClock(timeWithOffset,diff)
+            
+            else:
+                rtcSynced = True
+            time = rtc.datetime() 
+            print("[{:02d}:{:02d}:{:02d}]".format(time[4],time[5],time[6]),end=" ")
+            
+        # General error expection, need for a better handling...
+        except:
+            rtcSynced = False
+        
+        print("RTC synced: {}".format(rtcSynced))
+    
+    # Do controls right after new JSON
+    deviceChannels = int(controlsJson['Metadata']['Channels'])
+    lastRequest = int(controlsJson['Metadata']['Timestamp'])
+    time = rtc.datetime() 
+    print("[{:02d}:{:02d}:{:02d}]".format(time[4],time[5],time[6]),end=" ")
+    print('Channels to control: {}'.format(deviceChannels))
+    updateStatus()
+    doControls(False)
 
 
 def doControls(timerInitiated):
@@ -369,11 +516,10 @@ def doControls(timerInitiated):
     if controlsJson and hoursLeftOnJson > 0:
         channels = int(controlsJson['Metadata']['Channels'])
         
-        # If mqtt in use, open connection (experimental)
-        client = False
-        if mqtt_control:
+        # If mqtt in use and session is not open, connect (experimental)
+        if mqtt_control and not mqttClient:
             try:
-                client = mqttConnect()
+                mqttConnect()
             except:
                 print('           Could not establish mqtt connection')
             
@@ -393,10 +539,10 @@ def doControls(timerInitiated):
                         print('           --> Relay ON')
                     if channelMode == 'MQTT':
                         topic = globals()['channel{}_topic'.format(i + 1)]
-                        if client:
-                            client.publish(topic, msg='ON')
+                        published = mqttPublish(topic, b'ON')
+                        if published:
                             print('           --> Published ON to topic {}'.format(topic))
-                        else:
+                        elif published is None:
                             print('           --> Could not publish to topic {}'.format(topic))
                 else:
                     #if channelMode == 'GPIO':
@@ -406,10 +552,10 @@ def doControls(timerInitiated):
                         print('           --> Relay OFF')
                     if channelMode == 'MQTT':
                         topic = globals()['channel{}_topic'.format(i + 1)]
-                        if client:
-                            client.publish(topic, msg='OFF')
+                        published = mqttPublish(topic, b'OFF')
+                        if published:
                             print('           --> Published OFF to topic {}'.format(topic))
-                        else:
+                        elif published is None:
                             print('           --> Could not publish to topic {}'.format(topic))
                 i += 1
             except:
@@ -417,10 +563,6 @@ def doControls(timerInitiated):
                 i += 1
             controlError = 0
             
-        if client:
-            client.disconnect()
-
-            
         return True
         
     # If JSON data is expired, try failsafe. If not set, set all relays to 0
@@ -475,12 +617,24 @@ def runProgram(Timer):
     
     # Update state
     updateStatus()
-        
+    
+    # Connect MQTT session if it is not connected
+    if (mqtt_control or mqtt_push or mqtt_telemetry) and not mqttClient and connectionmanager.wlan_sta.isconnected():
+        try:
+            mqttConnect()
+        except Exception as e:
+            print('           Could not establish mqtt connection: {}'.format(e))
+    
+    if mqtt_telemetry and mqttClient:
+        mqttTelemetry()
 
     #If getControls timer not armed -> arm. Set timer also when out of connection to try periodically if connection becomes established
     if not getControlsTimerArmed:
-        #Set new random interval for timer: 90 sec + random 0-30 sec
-        requestInterval = random.randrange(30) + 90
+        #Set new random interval for timer: 90 sec + random 0-30 sec, with push session only fallback interval
+        if mqtt_push and mqttClient:
+            requestInterval = push_poll_interval + random.randrange(30)
+        else:
+            requestInterval = random.randrange(30) + 90
         
         time = rtc.datetime() 
         print("[{:02d}:{:02d}:{:02d}]".format(time[4],time[5],time[6]),end=" ")
@@ -533,20 +687,40 @@ def syncClock(t,diff):
     return rtcSynced
            
     
+def connectionChanged(oldState, newState):
+    time = rtc.datetime()
+    print("\n[{:02d}:{:02d}:{:02d}]".format(time[4],time[5],time[6]),end=" ")
+    print("Wifi: {} -> {}".format(connectionmanager.STATE_NAMES[oldState], connectionmanager.STATE_NAMES[newState]))
+
+# Advance wifi connection state machine. Timer is re-armed after each tick by connection state,
+# so ticks are frequent only while connecting.
+def connectionTick(Timer):
+    try:
+        connectionmanager.tick()
+    finally:
+        armConnectionTimer()
+
+def armConnectionTimer():
+    connectionTimer.init(mode=Timer.ONE_SHOT, period=connectionmanager.tick_interval(), callback=connectionTick)
+    
 # Start the program
 # RTC is probably not yet in time, but we save timestamp here and add add diff once time is synced
 bootTimestamp = mktime(localtime())
 
+# Connect wifi in background, relays are controlled and web server is served meanwhile
+connectionmanager.add_listener(connectionChanged)
+connectionmanager.start(profiles)
+armConnectionTimer()
+
 # Start program loop timer
 programTimer.init(mode=Timer.PERIODIC, period = 15 * 1000, callback=runProgram)
 
-# HTTP-server for info and managing settings, known bug, needs to be rewritten into function to reset socket state when wifi changes
-if connectionmanager.wlan_sta:
-    ip = connectionmanager.wlan_sta.ifconfig()[0]
-else:
-    ip = '0.0.0.0'
+# Check MQTT session for new messages and keep it alive every second
+if mqtt_control or mqtt_push or mqtt_telemetry:
+    mqttTimer.init(mode=Timer.PERIODIC, period = 1000, callback=mqttCheck)
 
-addr = socket.getaddrinfo(ip, 80)[0][-1]
+# HTTP-server for info and managing settings, listens on both wifi and access point interfaces
+addr = socket.getaddrinfo('0.0.0.0', 80)[0][-1]
 s = socket.socket()
 s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 s.bind(addr)
@@ -569,18 +743,18 @@ while True:
     upDays, upHours = divmod(upHours, 24)
     uptime = "{} days, {:02d} hours, {:02d} minutes, {:02d} seconds".format(upDays,upHours,upMinutes,upSeconds)
     if controlsJson:
-        if connectionmanager.wlan_ap.isconnected():
-            ip = '192.168.4.1'
-        else:
+        if connectionmanager.wlan_sta.isconnected():
             ip = connectionmanager.wlan_sta.ifconfig()[0]
+        else:
+            ip = '192.168.4.1'
         
         response = webpages.frontpage_with_json(controlsJson,relays,time,uptime,mac,ip)
             
     else:
-        if connectionmanager.wlan_ap.isconnected():
-            ip = '192.168.4.1'
-        else:
+        if connectionmanager.wlan_sta.isconnected():
             ip = connectionmanager.wlan_sta.ifconfig()[0]
+        else:
+            ip = '192.168.4.1'
             
         response = webpages.frontpage_without_json(time,uptime,mac,ip)
         
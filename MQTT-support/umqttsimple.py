@@ -1,215 +1,437 @@
-import usocket as socket
-import ustruct as struct
-from ubinascii import hexlify
-
-
-class MQTTException(Exception):
-    pass
-
-
-class MQTTClient:
-    def __init__(
-        self,
-        client_id,
-        server,
-        port=0,
-        user=None,
-        password=None,
-        keepalive=0,
-        ssl=False,
-        ssl_params={},
-    ):
-        if port == 0:
-            port = 8883 if ssl else 1883
-        self.client_id = client_id
-        self.sock = None
-        self.server = server
-        self.port = port
-        self.ssl = ssl
-        self.ssl_params = ssl_params
-        self.pid = 0
-        self.cb = None
-        self.user = user
-        self.pswd = password
-        self.keepalive = keepalive
-        self.lw_topic = None
-        self.lw_msg = None
-        self.lw_qos = 0
-        self.lw_retain = False
-
-    def _send_str(self, s):
-        self.sock.write(struct.pack("!H", len(s)))
-        self.sock.write(s)
-
-    def _recv_len(self):
-        n = 0
-        sh = 0
-        while 1:
-            b = self.sock.read(1)[0]
-            n |= (b & 0x7F) << sh
-            if not b & 0x80:
-                return n
-            sh += 7
-
-    def set_callback(self, f):
-        self.cb = f
-
-    def set_last_will(self, topic, msg, retain=False, qos=0):
-        assert 0 <= qos <= 2
-        assert topic
-        self.lw_topic = topic
-        self.lw_msg = msg
-        self.lw_qos = qos
-        self.lw_retain = retain
-
-    def connect(self, clean_session=True):
-        self.sock = socket.socket()
-        addr = socket.getaddrinfo(self.server, self.port)[0][-1]
-        self.sock.connect(addr)
-        if self.ssl:
-            import ussl
-
-            self.sock = ussl.wrap_socket(self.sock, **self.ssl_params)
-        premsg = bytearray(b"\x10\0\0\0\0\0")
-        msg = bytearray(b"\x04MQTT\x04\x02\0\0")
-
-        sz = 10 + 2 + len(self.client_id)
-        msg[6] = clean_session << 1
-        if self.user is not None:
-            sz += 2 + len(self.user) + 2 + len(self.pswd)
-            msg[6] |= 0xC0
-        if self.keepalive:
-            assert self.keepalive < 65536
-            msg[7] |= self.keepalive >> 8
-            msg[8] |= self.keepalive & 0x00FF
-        if self.lw_topic:
-            sz += 2 + len(self.lw_topic) + 2 + len(self.lw_msg)
-            msg[6] |= 0x4 | (self.lw_qos & 0x1) << 3 | (self.lw_qos & 0x2) << 3
-            msg[6] |= self.lw_retain << 5
-
-        i = 1
-        while sz > 0x7F:
-            premsg[i] = (sz & 0x7F) | 0x80
-            sz >>= 7
-            i += 1
-        premsg[i] = sz
-
-        self.sock.write(premsg, i + 2)
-        self.sock.write(msg)
-        # print(hex(len(msg)), hexlify(msg, ":"))
-        self._send_str(self.client_id)
-        if self.lw_topic:
-            self._send_str(self.lw_topic)
-            self._send_str(self.lw_msg)
-        if self.user is not None:
-            self._send_str(self.user)
-            self._send_str(self.pswd)
-        resp = self.sock.read(4)
-        assert resp[0] == 0x20 and resp[1] == 0x02
-        if resp[3] != 0:
-            raise MQTTException(resp[3])
-        return resp[2] & 1
-
-    def disconnect(self):
-        self.sock.write(b"\xe0\0")
-        self.sock.close()
-
-    def ping(self):
-        self.sock.write(b"\xc0\0")
-
-    def publish(self, topic, msg, retain=False, qos=0):
-        pkt = bytearray(b"\x30\0\0\0")
-        pkt[0] |= qos << 1 | retain
-        sz = 2 + len(topic) + len(msg)
-        if qos > 0:
-            sz += 2
-        assert sz < 2097152
-        i = 1
-        while sz > 0x7F:
-            pkt[i] = (sz & 0x7F) | 0x80
-            sz >>= 7
-            i += 1
-        pkt[i] = sz
-        # print(hex(len(pkt)), hexlify(pkt, ":"))
-        self.sock.write(pkt, i + 1)
-        self._send_str(topic)
-        if qos > 0:
-            self.pid += 1
-            pid = self.pid
-            struct.pack_into("!H", pkt, 0, pid)
-            self.sock.write(pkt, 2)
-        self.sock.write(msg)
-        if qos == 1:
-            while 1:
-                op = self.wait_msg()
-                if op == 0x40:
-                    sz = self.sock.read(1)
-                    assert sz == b"\x02"
-                    rcv_pid = self.sock.read(2)
-                    rcv_pid = rcv_pid[0] << 8 | rcv_pid[1]
-                    if pid == rcv_pid:
-                        return
-        elif qos == 2:
-            assert 0
-
-    def subscribe(self, topic, qos=0):
-        assert self.cb is not None, "Subscribe callback is not set"
-        pkt = bytearray(b"\x82\0\0\0")
-        self.pid += 1
-        struct.pack_into("!BH", pkt, 1, 2 + 2 + len(topic) + 1, self.pid)
-        # print(hex(len(pkt)), hexlify(pkt, ":"))
-        self.sock.write(pkt)
-        self._send_str(topic)
-        self.sock.write(qos.to_bytes(1, "little"))
-        while 1:
-            op = self.wait_msg()
-            if op == 0x90:
-                resp = self.sock.read(4)
-                # print(resp)
-                assert resp[1] == pkt[2] and resp[2] == pkt[3]
-                if resp[3] == 0x80:
-                    raise MQTTException(resp[3])
-                return
-
-    # Wait for a single incoming MQTT message and process it.
-    # Subscribed messages are delivered to a callback previously
-    # set by .set_callback() method. Other (internal) MQTT
-    # messages processed internally.
-    def wait_msg(self):
-        res = self.sock.read(1)
-        #self.sock.setblocking(True)
-        if res is None:
-            return None
-        if res == b"":
-            raise OSError(-1)
-        if res == b"\xd0":  # PINGRESP
-            sz = self.sock.read(1)[0]
-            assert sz == 0
-            return None
-        op = res[0]
-        if op & 0xF0 != 0x30:
-            return op
-        sz = self._recv_len()
-        topic_len = self.sock.read(2)
-        topic_len = (topic_len[0] << 8) | topic_len[1]
-        topic = self.sock.read(topic_len)
-        sz -= topic_len + 2
-        if op & 6:
-            pid = self.sock.read(2)
-            pid = pid[0] << 8 | pid[1]
-            sz -= 2
-        msg = self.sock.read(sz)
-        self.cb(topic, msg)
-        if op & 6 == 2:
-            pkt = bytearray(b"\x40\x02\0\0")
-            struct.pack_into("!H", pkt, 2, pid)
-            self.sock.write(pkt)
-        elif op & 6 == 4:
-            assert 0
-
-    # Checks whether a pending message from server is available.
-    # If not, returns immediately with None. Otherwise, does
-    # the same processing as wait_msg.
-    def check_msg(self):
-        self.sock.setblocking(False)
-        return self.wait_msg()
\ No newline at end of file
+import usocket as socket
+import ustruct as struct
+from ubinascii import hexlify
+from utime import ticks_ms, ticks_diff
+
+
+class MQTTException(Exception):
+    pass
+
+
+class MQTTClient:
+    def __init__(
+        self,
+        client_id,
+        server,
+        port=0,
+        user=None,
+        password=None,
+        keepalive=0,
+        ssl=False,
+        ssl_params={},
+        max_inflight=4,
+        retry_timeout=5000,
+        buffer_size=128,
+        recv_size=256,
+    ):
+        if port == 0:
+            port = 8883 if ssl else 1883
+        self.client_id = client_id
+        self.sock = None
+        self.server = server
+        self.port = port
+        self.ssl = ssl
+        self.ssl_params = ssl_params
+        self.pid = 0
+        self.cb = None
+        self.user = user
+        self.pswd = password
+        self.keepalive = keepalive
+        self.lw_topic = None
+        self.lw_msg = None
+        self.lw_qos = 0
+        self.lw_retain = False
+        # Outgoing QoS 1/2 messages waiting for acknowledge, by packet id:
+        # [sent ticks, topic, msg, retain, qos, PUBREC received]
+        self.inflight = {}
+        self.max_inflight = max_inflight
+        self.retry_timeout = retry_timeout
+        # Incoming QoS 2 packet ids waiting for PUBREL
+        self.rcv_pids = set()
+        # Packets are assembled here and sent with a single write. Buffer grows
+        # to the largest packet sent and is reused after that.
+        self.buf = bytearray(buffer_size)
+        self.mv = memoryview(self.buf)
+        # Received data is collected to a ring buffer and packets are processed
+        # only when they have arrived completely, so reads never block mid-packet.
+        self.rbuf = bytearray(recv_size)
+        self.rmv = memoryview(self.rbuf)
+        self.rpos = 0
+        self.rlen = 0
+        self.suback = None
+        # Ticks of the last PINGRESP (or CONNACK), caller can detect dead connection from it
+        self.last_pingresp = ticks_ms()
+        # Encoded topics by str, so publishing to the same topics doesn't encode them again
+        self.topics = {}
+
+    def _buffer(self, n):
+        if n > len(self.buf):
+            self.buf = bytearray(n)
+            self.mv = memoryview(self.buf)
+        return self.buf
+
+    def _put_len(self, i, sz):
+        buf = self.buf
+        while sz > 0x7F:
+            buf[i] = (sz & 0x7F) | 0x80
+            sz >>= 7
+            i += 1
+        buf[i] = sz
+        return i + 1
+
+    def _put_str(self, i, s):
+        n = len(s)
+        self.buf[i] = n >> 8
+        self.buf[i + 1] = n & 0xFF
+        self.buf[i + 2 : i + 2 + n] = s
+        return i + 2 + n
+
+    # Send n first bytes of buffer. Rest is written in pieces only if socket
+    # could not take the whole packet at once.
+    def _write(self, n):
+        sent = self.sock.write(self.buf, n)
+        if sent is None:
+            sent = 0
+        while sent < n:
+            w = self.sock.write(self.mv[sent:n])
+            if w:
+                sent += w
+
+    @staticmethod
+    def _bytes(s):
+        return s.encode() if isinstance(s, str) else s
+
+    def _topic(self, topic):
+        if not isinstance(topic, str):
+            return topic
+        encoded = self.topics.get(topic)
+        if encoded is None:
+            encoded = topic.encode()
+            self.topics[topic] = encoded
+        return encoded
+
+    # Read available data to ring buffer. In blocking mode returns after the
+    # first read, so it never waits for data that is not needed.
+    def _recv_fill(self, once=False):
+        size = len(self.rbuf)
+        while self.rlen < size:
+            end = (self.rpos + self.rlen) % size
+            n = (self.rpos if end < self.rpos else size) - end
+            try:
+                r = self.sock.readinto(self.rmv[end : end + n])
+            except OSError as e:
+                if e.args[0] == 11:  # EAGAIN
+                    return
+                raise
+            if r is None:
+                return
+            if r == 0:
+                raise OSError(-1)
+            self.rlen += r
+            if once:
+                return
+
+    def _recv_byte(self, i):
+        return self.rbuf[(self.rpos + i) % len(self.rbuf)]
+
+    def _recv_skip(self, n):
+        self.rpos = (self.rpos + n) % len(self.rbuf)
+        self.rlen -= n
+
+    def _recv_take(self, n):
+        size = len(self.rbuf)
+        end = self.rpos + n
+        if end <= size:
+            data = bytes(self.rmv[self.rpos : end])
+        else:
+            data = bytes(self.rmv[self.rpos :]) + bytes(self.rmv[: end - size])
+        self._recv_skip(n)
+        return data
+
+    def _recv_pid(self):
+        pid = self._recv_byte(0) << 8 | self._recv_byte(1)
+        self._recv_skip(2)
+        return pid
+
+    # Fixed header of the next packet as (op, header length, remaining length),
+    # None if the packet has not been received completely yet
+    def _recv_header(self):
+        n = 0
+        sh = 0
+        i = 1
+        while 1:
+            if i >= self.rlen:
+                return None
+            b = self._recv_byte(i)
+            n |= (b & 0x7F) << sh
+            i += 1
+            if not b & 0x80:
+                break
+            sh += 7
+        if i + n > len(self.rbuf):
+            # Packet doesn't fit, data is moved to a bigger buffer
+            length = self.rlen
+            rbuf = bytearray(i + n)
+            rbuf[:length] = self._recv_take(length)
+            self.rbuf = rbuf
+            self.rmv = memoryview(rbuf)
+            self.rpos = 0
+            self.rlen = length
+        if i + n > self.rlen:
+            return None
+        return self._recv_byte(0), i, n
+
+    def set_callback(self, f):
+        self.cb = f
+
+    def set_last_will(self, topic, msg, retain=False, qos=0):
+        assert 0 <= qos <= 2
+        assert topic
+        self.lw_topic = topic
+        self.lw_msg = msg
+        self.lw_qos = qos
+        self.lw_retain = retain
+
+    def connect(self, clean_session=True):
+        self.sock = socket.socket()
+        addr = socket.getaddrinfo(self.server, self.port)[0][-1]
+        self.sock.connect(addr)
+        if self.ssl:
+            import ussl
+
+            self.sock = ussl.wrap_socket(self.sock, **self.ssl_params)
+        client_id = self._bytes(self.client_id)
+        sz = 10 + 2 + len(client_id)
+        flags = clean_session << 1
+        if self.user is not None:
+            user = self._bytes(self.user)
+            pswd = self._bytes(self.pswd)
+            sz += 2 + len(user) + 2 + len(pswd)
+            flags |= 0xC0
+        if self.keepalive:
+            assert self.keepalive < 65536
+        if self.lw_topic:
+            lw_topic = self._bytes(self.lw_topic)
+            lw_msg = self._bytes(self.lw_msg)
+            sz += 2 + len(lw_topic) + 2 + len(lw_msg)
+            flags |= 0x4 | (self.lw_qos & 0x1) << 3 | (self.lw_qos & 0x2) << 3
+            flags |= self.lw_retain << 5
+
+        buf = self._buffer(sz + 5)
+        buf[0] = 0x10
+        i = self._put_len(1, sz)
+        buf[i : i + 7] = b"\0\x04MQTT\x04"
+        buf[i + 7] = flags
+        buf[i + 8] = self.keepalive >> 8
+        buf[i + 9] = self.keepalive & 0x00FF
+        i = self._put_str(i + 10, client_id)
+        if self.lw_topic:
+            i = self._put_str(i, lw_topic)
+            i = self._put_str(i, lw_msg)
+        if self.user is not None:
+            i = self._put_str(i, user)
+            i = self._put_str(i, pswd)
+        # print(hex(i), hexlify(buf[:i], ":"))
+        self._write(i)
+        self.rpos = 0
+        self.rlen = 0
+        resp = self.sock.read(4)
+        assert resp[0] == 0x20 and resp[1] == 0x02
+        if resp[3] != 0:
+            raise MQTTException(resp[3])
+        self.last_pingresp = ticks_ms()
+        # Unacknowledged messages are sent again only if broker has kept the session
+        # (session present flag), otherwise session state is discarded
+        session_present = resp[2] & 1
+        if clean_session or not session_present:
+            self.inflight = {}
+            self.rcv_pids = set()
+        else:
+            self._retransmit(True)
+        return session_present
+
+    def disconnect(self):
+        self.sock.write(b"\xe0\0")
+        self.sock.close()
+
+    def ping(self):
+        self.sock.write(b"\xc0\0")
+
+    # QoS 1 and 2 messages are not waited for, up to max_inflight messages can be
+    # unacknowledged at a time. Returns packet id (0 for QoS 0). Message is encoded
+    # only if it is given as str, pass bytes to avoid allocation.
+    def publish(self, topic, msg, retain=False, qos=0):
+        assert 0 <= qos <= 2
+        topic = self._topic(topic)
+        msg = self._bytes(msg)
+        if qos == 0:
+            self._send_publish(topic, msg, retain, 0, 0, False)
+            return 0
+        while len(self.inflight) >= self.max_inflight:
+            self._wait_ack()
+        pid = self._next_pid()
+        self.inflight[pid] = [ticks_ms(), topic, msg, retain, qos, False]
+        self._send_publish(topic, msg, retain, qos, pid, False)
+        return pid
+
+    def _next_pid(self):
+        while True:
+            self.pid = self.pid % 65535 + 1
+            if self.pid not in self.inflight:
+                return self.pid
+
+    # Topic and msg are bytes
+    def _send_publish(self, topic, msg, retain, qos, pid, dup):
+        sz = 2 + len(topic) + len(msg)
+        if qos > 0:
+            sz += 2
+        assert sz < 2097152
+        buf = self._buffer(sz + 5)
+        buf[0] = 0x30 | dup << 3 | qos << 1 | retain
+        i = self._put_len(1, sz)
+        i = self._put_str(i, topic)
+        if qos > 0:
+            struct.pack_into("!H", buf, i, pid)
+            i += 2
+        buf[i : i + len(msg)] = msg
+        i += len(msg)
+        # print(hex(i), hexlify(buf[:i], ":"))
+        self._write(i)
+
+    def _send_ack(self, op, pid):
+        buf = self.buf
+        buf[0] = op
+        buf[1] = 2
+        struct.pack_into("!H", buf, 2, pid)
+        self._write(4)
+
+    # Send again messages which have not been acknowledged in retry_timeout (or all if forced):
+    # PUBLISH with DUP flag, or PUBREL if PUBREC has been received already.
+    def _retransmit(self, force=False):
+        for pid in self.inflight:
+            item = self.inflight[pid]
+            if force or ticks_diff(ticks_ms(), item[0]) > self.retry_timeout:
+                item[0] = ticks_ms()
+                if item[5]:
+                    self._send_ack(0x62, pid)
+                else:
+                    self._send_publish(item[1], item[2], item[3], item[4], pid, True)
+
+    # Handle acknowledge packets of QoS 1 and 2 flows
+    def _recv_ack(self, op, pid):
+        if op == 0x40 or op == 0x70:  # PUBACK, PUBCOMP
+            self.inflight.pop(pid, None)
+        elif op == 0x50:  # PUBREC
+            item = self.inflight.get(pid)
+            if item:
+                item[0] = ticks_ms()
+                item[5] = True
+            self._send_ack(0x62, pid)
+        elif op == 0x62:  # PUBREL
+            self.rcv_pids.discard(pid)
+            self._send_ack(0x70, pid)
+
+    # Wait for next packet at most retry_timeout, then send again unacknowledged messages
+    def _wait_ack(self):
+        self.sock.settimeout(self.retry_timeout / 1000)
+        try:
+            self._wait_packet()
+        except OSError as e:
+            if e.args[0] != 110:  # ETIMEDOUT
+                raise
+        finally:
+            self.sock.settimeout(None)
+        self._retransmit()
+
+    # Wait until all QoS 1 and 2 messages are acknowledged
+    def wait_inflight(self):
+        while self.inflight:
+            self._wait_ack()
+
+    def subscribe(self, topic, qos=0):
+        assert self.cb is not None, "Subscribe callback is not set"
+        topic = self._bytes(topic)
+        pid = self._next_pid()
+        sz = 2 + 2 + len(topic) + 1
+        buf = self._buffer(sz + 5)
+        buf[0] = 0x82
+        i = self._put_len(1, sz)
+        struct.pack_into("!H", buf, i, pid)
+        i = self._put_str(i + 2, topic)
+        buf[i] = qos
+        # print(hex(i + 1), hexlify(buf[:i + 1], ":"))
+        self._write(i + 1)
+        self.suback = None
+        while 1:
+            op = self.wait_msg()
+            if op == 0x90 and self.suback[0] == pid:
+                if self.suback[1] == 0x80:
+                    raise MQTTException(self.suback[1])
+                return
+
+    # Process next packet from ring buffer. Returns packet type or None if
+    # there is no complete packet received.
+    def _recv_packet(self):
+        header = self._recv_header()
+        if header is None:
+            return None
+        op, i, sz = header
+        self._recv_skip(i)
+        if op in (0x40, 0x50, 0x62, 0x70):
+            self._recv_ack(op, self._recv_pid())
+            sz -= 2
+        elif op == 0x90:  # SUBACK
+            self.suback = (self._recv_pid(), self._recv_byte(0))
+            sz -= 2
+        elif op == 0xD0:  # PINGRESP
+            self.last_pingresp = ticks_ms()
+        elif op & 0xF0 == 0x30:  # PUBLISH
+            topic_len = self._recv_pid()
+            topic = self._recv_take(topic_len)
+            sz -= topic_len + 2
+            if op & 6:
+                pid = self._recv_pid()
+                sz -= 2
+            msg = self._recv_take(sz)
+            sz = 0
+            if op & 6 == 4:
+                # QoS 2: message is delivered once, duplicates are only acknowledged
+                if pid not in self.rcv_pids:
+                    self.rcv_pids.add(pid)
+                    self.cb(topic, msg)
+                self._send_ack(0x50, pid)
+            else:
+                self.cb(topic, msg)
+                if op & 6 == 2:
+                    self._send_ack(0x40, pid)
+        self._recv_skip(sz)
+        return op
+
+    def _wait_packet(self):
+        while 1:
+            op = self._recv_packet()
+            if op is not None:
+                return op
+            self._recv_fill(True)
+
+    # Wait for a single incoming MQTT message and process it.
+    # Subscribed messages are delivered to a callback previously
+    # set by .set_callback() method. Other (internal) MQTT
+    # messages processed internally. Returns packet type.
+    def wait_msg(self):
+        self.sock.setblocking(True)
+        return self._wait_packet()
+
+    # Process all completely received packets without blocking. Packets
+    # arriving in pieces are collected over several calls. Returns type of
+    # the last packet processed, None if there was none.
+    def check_msg(self):
+        self._retransmit()
+        self.sock.setblocking(False)
+        op = None
+        while 1:
+            self._recv_fill()
+            res = self._recv_packet()
+            if res is None:
+                return op
+            op = res
@@ -8,78 +8,385 @@ except:
     import socket
 import network
 import time
+import json
+from ubinascii import hexlify, unhexlify
 
 # Siirrä configiin
 ap_ssid = "Pico_porssari"
 ap_password = "Pico_pass"
 ap_authmode = 3  # WPA2
 
+# Connection states
+IDLE = 0
+SCANNING = 1
+CONNECTING = 2
+CONNECTED = 3
+AP_FALLBACK = 4
+STATE_NAMES = ('IDLE', 'SCANNING', 'CONNECTING', 'CONNECTED', 'AP_FALLBACK')
+
+# Seconds to wait for an access point to connect (last network / scanned network)
+fast_connect_timeout = 3
+connect_timeout = 10
+
+# Access point is kept up while known networks are retried in background. Delay between
+# retries is doubled after each failed round up to max_retry_interval (seconds).
+# Access point is shut down when wifi is connected, unless ap_always_on is set.
+retry_interval = 30
+max_retry_interval = 600
+ap_always_on = False
+
+# Last succesfully connected network (ssid, bssid, channel) is kept in RAM and flash,
+# and reconnecting to it is tried first without scanning
+last_network_file = "lastnetwork.json"
+last_network = None
+
+# Scan results of known networks are cached by bssid and reused for scan_ttl seconds, so
+# reconnecting doesn't need a new scan every time. RSSI is smoothed over scans (rssi_weight
+# is the weight of new sample) and connection results are counted. Candidates are ranked by
+# smoothed RSSI minus failure_penalty dB for each failure in a row, and access point which
+# has failed max_failures times in a row is skipped for failure_hold seconds.
+scan_ttl = 300
+rssi_weight = 0.3
+failure_penalty = 10
+max_failures = 3
+failure_hold = 600
+
+# bssid: [ssid, channel, rssi, seen_ticks, successes, failures, failed_ticks]
+scan_cache = {}
+scan_ticks = None
+
+# Link quality telemetry, read with telemetry(). RSSI is sampled every rssi_interval seconds
+# while connected and rssi_history latest samples are kept. Time from connect() to IP address
+# is counted into histogram buckets (upper limits in seconds, last bucket is for longer).
+# Request round-trip times are recorded by the caller with record_request().
+rssi_interval = 60
+rssi_history = 10
+connect_buckets = (1, 2, 5, 10, 30)
+
+stats = {
+    'connects': 0,
+    'reconnects': 0,
+    'connect_failures': 0,
+    'connection_lost': 0,
+    'scans': 0,
+    'connect_histogram': [0] * (len(connect_buckets) + 1),
+    'dhcp_ms': None,
+    'rssi': [],
+    'requests': 0,
+    'request_errors': 0,
+    'request_ms': None,
+    'request_avg_ms': None,
+    'request_max_ms': 0
+}
+rssi_ticks = 0
+link_ticks = None
+
 # Define wifi variables
 wlan_ap = network.WLAN(network.AP_IF)
 wlan_sta = network.WLAN(network.STA_IF)
 
-        
-def get_connection(profiles):
-    """return a working WLAN(STA_IF) instance or None"""
+# Connection is handled by a state machine which is advanced by calling tick() periodically.
+# Waiting for connection is done between ticks, so tick() returns right away (except
+# scan, which driver does synchronously). Other modules can follow state changes with
+# add_listener(). Caller waits tick_interval() milliseconds between ticks: short while
+# connecting and long while connected or waiting in access point mode.
+fast_tick_interval = 200
+slow_tick_interval = 5000
+
+state = IDLE
+state_ticks = 0
+profiles = {}
+candidates = []
+current = None
+fast_connect = False
+retry_delay = retry_interval
+listeners = []
+
+def load_last_network():
+    global last_network
+    try:
+        with open(last_network_file, "r") as jsonfile:
+            data = json.load(jsonfile)
+            last_network = (data['ssid'], unhexlify(data['bssid']), data['channel'])
+    except (OSError, ValueError, KeyError):
+        last_network = None
+
+def save_last_network(network_info):
+    global last_network
+    if network_info == last_network:
+        return
+    last_network = network_info
+    try:
+        with open(last_network_file, "w") as jsonfile:
+            json.dump({'ssid': network_info[0], 'bssid': hexlify(network_info[1]).decode(), 'channel': network_info[2]}, jsonfile)
+    except OSError as e:
+        print("Could not save last network: {}".format(e))
+
+def add_listener(callback):
+    """callback(old_state, new_state) is called on every state change"""
+    listeners.append(callback)
 
-    # First check if there already is any connection:
-    time.sleep(3)
+def set_state(new_state):
+    global state, state_ticks
+    old_state = state
+    state = new_state
+    state_ticks = time.ticks_ms()
+    if new_state == old_state:
+        return
+    for callback in listeners:
+        try:
+            callback(old_state, new_state)
+        except Exception as e:
+            print("Error in connection listener: {}".format(e))
+
+def seconds_since(ticks):
+    return time.ticks_diff(time.ticks_ms(), ticks) / 1000
+
+def state_seconds():
+    return seconds_since(state_ticks)
+
+def is_failing(entry):
+    return entry[5] >= max_failures and seconds_since(entry[6]) < failure_hold
+
+def record_result(network_info, connected):
+    """count connection success or failure of access point"""
+    ssid, bssid, channel = network_info
+    entry = scan_cache.get(bssid)
+    if entry is None:
+        entry = [ssid, channel, None, None, 0, 0, 0]
+        scan_cache[bssid] = entry
+    if connected:
+        entry[4] += 1
+        entry[5] = 0
+    else:
+        entry[5] += 1
+        entry[6] = time.ticks_ms()
+
+def start(known_profiles):
+    """start connecting to known networks, connection is made by calling tick()"""
+    global profiles
+    profiles = known_profiles
+    set_state(IDLE)
+
+def tick():
+    """advance connection state machine one step"""
+    if state == IDLE:
+        check_idle()
+    elif state == SCANNING:
+        scan()
+    elif state == CONNECTING:
+        check_connecting()
+    elif state == CONNECTED:
+        if not wlan_sta.isconnected():
+            print("Wifi connection lost")
+            stats['connection_lost'] += 1
+            set_state(IDLE)
+        elif seconds_since(rssi_ticks) >= rssi_interval:
+            sample_rssi()
+    elif state == AP_FALLBACK:
+        if profiles and state_seconds() >= retry_delay:
+            set_state(IDLE)
+
+def tick_interval():
+    if state in (CONNECTED, AP_FALLBACK):
+        return slow_tick_interval
+    return fast_tick_interval
+
+def check_idle():
+    global candidates, fast_connect
     if wlan_sta.isconnected():
-        return wlan_sta
-    wlan_sta.active(False)
-    connected = False
-     
-    if profiles:  
+        set_state(CONNECTED)
+        return
+    if not profiles:
+        start_ap()
+        return
+
+    # Fast path: connect straight to access point used last time
+    wlan_sta.active(True)
+    entry = scan_cache.get(last_network[1]) if last_network else None
+    if last_network and last_network[0] in profiles and not (entry and is_failing(entry)):
+        print("Reconnecting to last network (channel {}).".format(last_network[2]))
+        candidates = [last_network]
+        fast_connect = True
+        connect_next()
+    else:
+        set_state(SCANNING)
+
+def scan():
+    global candidates, fast_connect
+    wlan_sta.active(True)
+    if scan_ticks is None or seconds_since(scan_ticks) >= scan_ttl:
         print("Found saved wifi-profiles, scan if there are known networks in range.")
+        update_scan_cache()
+    else:
+        print("Using scan results from {} seconds ago.".format(int(seconds_since(scan_ticks))))
+    candidates = rank_candidates()
+    fast_connect = False
+    connect_next()
 
-        # Search WiFis in range
-        wlan_sta.active(True)
+def update_scan_cache():
+    global scan_ticks
+    # Search WiFis in range
+    stats['scans'] += 1
+    try:
         networks = wlan_sta.scan()
+    except OSError as e:
+        print("Scan failed: {}".format(e))
+        return
+
+    now = time.ticks_ms()
+    for ssid, bssid, channel, rssi, security, hidden in networks:
+        ssid = ssid.decode('utf-8')
+        if ssid not in profiles:
+            continue
+        entry = scan_cache.get(bssid)
+        if entry is None:
+            scan_cache[bssid] = [ssid, channel, rssi, now, 0, 0, 0]
+        else:
+            entry[0] = ssid
+            entry[1] = channel
+            entry[2] = rssi if entry[2] is None else entry[2] + (rssi - entry[2]) * rssi_weight
+            entry[3] = now
+    scan_ticks = now
+
+def rank_candidates():
+    """known networks seen in the latest scan, best first"""
+    ranked = []
+    for bssid, entry in scan_cache.items():
+        if scan_ticks is None or entry[3] != scan_ticks:
+            continue
+        if is_failing(entry):
+            print("Skipping {} ({}), failed {} times in a row".format(entry[0], hexlify(bssid, ':').decode(), entry[5]))
+            continue
+        ranked.append((entry[2] - entry[5] * failure_penalty, (entry[0], bssid, entry[1])))
+    ranked.sort(key=lambda x: x[0], reverse=True)
+    return [network_info for score, network_info in ranked]
+
+def connect_next():
+    global current, link_ticks
+    if not candidates:
+        # Last network was not found, scan for others
+        if fast_connect:
+            set_state(SCANNING)
+        else:
+            start_ap()
+        return
+
+    current = candidates.pop(0)
+    ssid, bssid, channel = current
+    print('Trying to connect to %s' % ssid)
+    if fast_connect:
+        # Channel is known from last connection, so driver doesn't need to scan all channels
+        wlan_sta.connect(ssid, profiles[ssid] or None, bssid=bssid, channel=channel)
+    else:
+        wlan_sta.connect(ssid, profiles[ssid] or None, bssid=bssid)
+    link_ticks = None
+    set_state(CONNECTING)
+
+def check_connecting():
+    global retry_delay, link_ticks
+    status = wlan_sta.status()
+    if wlan_sta.isconnected():
+        print('Connected. IP: {}'.format(wlan_sta.ifconfig()[0]))
+        save_last_network(current)
+        record_result(current, True)
+        record_connect()
+        retry_delay = retry_interval
+        if wlan_ap.active() and not ap_always_on:
+            wlan_ap.active(False)
+            print('WiFi-AP closed')
+        set_state(CONNECTED)
+        return
+
+    # Status 2 is link up and waiting for IP address from DHCP
+    if status == 2 and link_ticks is None:
+        link_ticks = time.ticks_ms()
+
+    # Negative status is connection failure (wrong password, no access point..)
+    timeout = fast_connect_timeout if fast_connect else connect_timeout
+    if status < 0 or state_seconds() >= timeout:
+        print('Failed. Not Connected to: ' + current[0])
+        record_result(current, False)
+        stats['connect_failures'] += 1
+        wlan_sta.disconnect()
+        connect_next()
 
-        AUTHMODE = {0: "open", 1: "WEP", 2: "WPA-PSK", 3: "WPA2-PSK", 4: "WPA/WPA2-PSK"}
-        for ssid, bssid, channel, rssi, security, hidden in sorted(networks, key=lambda x: x[3], reverse=True):
-            ssid = ssid.decode('utf-8')
-            encrypted = security > 0
-            #print(security)
-            #print("ssid: %s chan: %d rssi: %d authmode: %s" % (ssid, channel, rssi, AUTHMODE.get(security, '?')))
-            if ssid in profiles:
-                if encrypted:
-                    password = profiles[ssid]
-                    connected = do_connect(ssid, password)
-                else:
-                    connected = do_connect(ssid, None)
-            if connected:
-                break
-    #try:
-    #    print("something")
-    #except OSError as e:
-    #    print("exception", str(e))
-
-    # start web server for connection manager:
-    if not connected:
-        wlan_sta.active(False)
-        # If already started, no need to start again
-        if wlan_ap.isconnected():
-            return wlan_ap
-        
+# start web server for connection manager:
+def start_ap():
+    global retry_delay, scan_ticks
+    # Networks may have changed, next round scans again
+    scan_ticks = None
+    # If already started, no need to start again. Station stays active for retries.
+    if wlan_ap.active():
+        retry_delay = min(retry_delay * 2, max_retry_interval)
+    else:
         wlan_ap.config(essid=ap_ssid, password=ap_password)
         wlan_ap.active(True)
         print('Created WiFi-AP with ssid ' + ap_ssid + ' and password: ' + ap_password + ' with host 192.168.4.1.')
-        return wlan_ap
-
-    return wlan_sta if connected else None
+    print('Trying known networks again in {} seconds'.format(retry_delay))
+    set_state(AP_FALLBACK)
 
-def do_connect(ssid, password):
-    print('Trying to connect to %s' % ssid, end='')
-    wlan_sta.connect(ssid, password)
-    for retry in range(100):
-        connected = wlan_sta.isconnected()
-        if connected:
+def record_connect():
+    connect_seconds = state_seconds()
+    for i, limit in enumerate(connect_buckets):
+        if connect_seconds <= limit:
             break
-        time.sleep(0.1)
-        print('.', end='')
-    if connected:
-        print('\nConnected. IP: {}'.format(wlan_sta.ifconfig()[0]))
     else:
-        print('\nFailed. Not Connected to: ' + ssid)
-    return connected
+        i = len(connect_buckets)
+    stats['connect_histogram'][i] += 1
+    if stats['connects']:
+        stats['reconnects'] += 1
+    stats['connects'] += 1
+    stats['dhcp_ms'] = time.ticks_diff(time.ticks_ms(), link_ticks) if link_ticks is not None else None
+    sample_rssi()
+
+def sample_rssi():
+    global rssi_ticks
+    rssi_ticks = time.ticks_ms()
+    try:
+        rssi = wlan_sta.status('rssi')
+    except (OSError, ValueError):
+        return
+    samples = stats['rssi']
+    samples.append(rssi)
+    if len(samples) > rssi_history:
+        samples.pop(0)
+
+    # Connected access point's RSSI is smoothed into scan cache as well
+    entry = scan_cache.get(current[1]) if current else None
+    if entry and entry[2] is not None:
+        entry[2] += (rssi - entry[2]) * rssi_weight
+
+def record_request(ms):
+    """record round-trip time of a server request in milliseconds, None if request failed"""
+    stats['requests'] += 1
+    if ms is None:
+        stats['request_errors'] += 1
+        return
+    stats['request_ms'] = ms
+    stats['request_max_ms'] = max(stats['request_max_ms'], ms)
+    if stats['request_avg_ms'] is None:
+        stats['request_avg_ms'] = ms
+    else:
+        stats['request_avg_ms'] += (ms - stats['request_avg_ms']) // 8
+
+def telemetry():
+    """connection state and link quality counters as dict"""
+    result = dict(stats)
+    result['state'] = STATE_NAMES[state]
+    result['connect_buckets'] = connect_buckets
+    result['ssid'] = current[0] if current and state == CONNECTED else None
+    result['rssi'] = list(stats['rssi'])
+    result['connect_histogram'] = list(stats['connect_histogram'])
+    return result
+
+def addresses():
+    """ip addresses of active interfaces"""
+    result = []
+    if wlan_sta.isconnected():
+        result.append(wlan_sta.ifconfig()[0])
+    if wlan_ap.active():
+        result.append(wlan_ap.ifconfig()[0])
+    return tuple(result)
+
+load_last_network()
@@ -0,0 +1,133 @@
+# Incremental JSON parser. Stream is read in small chunks and handler is called with
+# (path, value) for each scalar value in the document, eg. (['Metadata', 'Channels'], '8').
+# Path list is shared and modified while parsing, so handler must not keep it.
+# Objects and arrays are never built into memory.
+
+WHITESPACE = (0x20, 0x09, 0x0D, 0x0A)
+LITERAL_END = (0x20, 0x09, 0x0D, 0x0A, 0x2C, 0x5D, 0x7D)
+ESCAPES = {ord('b'): '\b', ord('f'): '\f', ord('n'): '\n', ord('r'): '\r', ord('t'): '\t'}
+
+class Parser:
+    def __init__(self, stream, bufferSize=128):
+        self.stream = stream
+        self.buffer = bytearray(bufferSize)
+        self.length = 0
+        self.pos = 0
+        self.c = -1
+
+    # Move to next byte, c is -1 at the end of stream
+    def _advance(self):
+        if self.pos >= self.length:
+            self.length = self.stream.readinto(self.buffer) or 0
+            self.pos = 0
+            if not self.length:
+                self.c = -1
+                return
+        self.c = self.buffer[self.pos]
+        self.pos += 1
+
+    def _skipWhitespace(self):
+        while self.c >= 0 and self.c in WHITESPACE:
+            self._advance()
+
+    def _expect(self, c):
+        self._skipWhitespace()
+        if self.c != c:
+            raise ValueError('JSON: expected {!r} at {!r}'.format(chr(c), chr(self.c) if self.c >= 0 else 'end'))
+        self._advance()
+
+    def _string(self):
+        self._expect(ord('"'))
+        chars = bytearray()
+        while True:
+            c = self.c
+            if c < 0:
+                raise ValueError('JSON: unterminated string')
+            self._advance()
+            if c == 0x22:
+                break
+            if c == 0x5C:
+                c = self.c
+                self._advance()
+                if c == ord('u'):
+                    code = 0
+                    for i in range(4):
+                        code = code * 16 + int(chr(self.c), 16)
+                        self._advance()
+                    chars.extend(chr(code).encode())
+                elif c in ESCAPES:
+                    chars.extend(ESCAPES[c].encode())
+                else:
+                    chars.append(c)
+            else:
+                chars.append(c)
+        return chars.decode()
+
+    def _literal(self):
+        chars = bytearray()
+        while self.c >= 0 and self.c not in LITERAL_END:
+            chars.append(self.c)
+            self._advance()
+        literal = chars.decode()
+        if literal == 'true':
+            return True
+        elif literal == 'false':
+            return False
+        elif literal == 'null':
+            return None
+        try:
+            return int(literal)
+        except ValueError:
+            return float(literal)
+
+    def _value(self, path, handler):
+        self._skipWhitespace()
+        if self.c == ord('{'):
+            self._advance()
+            self._skipWhitespace()
+            if self.c == ord('}'):
+                self._advance()
+                return
+            while True:
+                path.append(self._string())
+                self._expect(ord(':'))
+                self._value(path, handler)
+                path.pop()
+                self._skipWhitespace()
+                if self.c == ord(','):
+                    self._advance()
+                else:
+                    self._expect(ord('}'))
+                    return
+        elif self.c == ord('['):
+            self._advance()
+            self._skipWhitespace()
+            if self.c == ord(']'):
+                self._advance()
+                return
+            i = 0
+            while True:
+                path.append(i)
+                self._value(path, handler)
+                path.pop()
+                i += 1
+                self._skipWhitespace()
+                if self.c == ord(','):
+                    self._advance()
+                else:
+                    self._expect(ord(']'))
+                    return
+        elif self.c == ord('"'):
+            handler(path, self._string())
+        elif self.c < 0:
+            raise ValueError('JSON: unexpected end')
+        else:
+            handler(path, self._literal())
+
+    def parse(self, handler):
+        self._advance()
+        self._value([], handler)
+
+
+def parse(stream, handler, bufferSize=128):
+    Parser(stream, bufferSize).parse(handler)
@@ -23,15 +23,19 @@ except:
 # Import custom python modules
 import connectionmanager
 #import webpages
+import relaycontrol
+import schedule
+import jsonstream
+import storage
+import pollplanner
     
 # Import libs to read and convert data
 import json
 from ubinascii import hexlify
-import random
 #from math import floor
 
 #import time
-from time import sleep, mktime, gmtime, time
+from time import sleep, mktime, gmtime, time, ticks_ms, ticks_diff
 
 # Import pin-control
 from machine import Pin, Timer
@@ -48,6 +52,8 @@ offset = 0
 
 # Timers
 programTimer = Timer()
+controlTimer = Timer()
+connectionTimer = Timer()
 
 # Onboard led
 onboard = Pin("LED", Pin.OUT, value=0)
@@ -58,18 +64,14 @@ np[0] = (255, 0, 0)
 np.write()
 
 
-# Relay pins
-relay0 = Pin(21, Pin.OUT)
-relay1 = Pin(20, Pin.OUT)
-relay2 = Pin(19, Pin.OUT)
-relay3 = Pin(18, Pin.OUT)
-relay4 = Pin(17, Pin.OUT)
-relay5 = Pin(16, Pin.OUT)
-relay6 = Pin(15, Pin.OUT)
-relay7 = Pin(14, Pin.OUT)
+# Persistent data is written to flash at most once per interval (seconds)
+storageFlushInterval = 600
 
-# Tuple for web interface (add all the relays above for proper functionality)
-#relays = (relay1, relay2, relay3, relay4, relay5, relay6, relay7, relay8)
+# Maximum seconds between server requests when schedule has not changed (can be overridden with Poll_interval_max in config.json)
+pollIntervalMax = 2700
+
+# Relay pins for switch ids 0-7 (can be overridden with Relay_pins list in config.json)
+relayPins = (21, 20, 19, 18, 17, 16, 15, 14)
 
 # Get config from json 
 try:
@@ -82,6 +84,18 @@ try:
         # Get failsafe-setting
         failsafe = data['Failsafe']
         
+        # Get relay pins
+        if 'Relay_pins' in data:
+            relayPins = data['Relay_pins']
+        
+        # Get maximum server request interval
+        if 'Poll_interval_max' in data:
+            pollIntervalMax = data['Poll_interval_max']
+        
+        # Get minimum interval (seconds) between flash writes
+        if 'Storage_flush_interval' in data:
+            storageFlushInterval = data['Storage_flush_interval']
+        
         updatePeriod = 15000
         deviceChannels = 0
         returnTimestamps = 20
@@ -115,6 +129,10 @@ except:
     print("Error! Could not retrieve configs, rebooting..")
     machine.reset()
     
+# Relays, switch id to pin mapping is built once here. Tuple of pins for web interface.
+relayBank = relaycontrol.RelayBank([Pin(pin, Pin.OUT) for pin in relayPins], 0)
+relays = relayBank.pins
+
 # Get device mac from wifi adapter
 try:
     deviceMacHex = connectionmanager.wlan_sta.config('mac')
@@ -145,9 +163,6 @@ except:
         print("Error with device MAC, rebooting..")
         machine.reset()
 
-# Get wifi connection (Returns wlan_sta or wlan_ap)
-wifi = connectionmanager.get_connection(profiles)
-
 # Program state variables
 controlsReady = False
 getControlsInit = False
@@ -156,12 +171,20 @@ lastRequest = 0
 lastRequestHttpCode = 0
 jsonValidUntil = 0
 controlsJson = {}
+channelSchedules = []
 channelLastControlTimeStamps = {}
 mainCycleCounter = 20 
+# Schedules loaded from flash which can't be used before RTC is in time, (metadata, schedules)
+cachedSchedule = None
+# Metadata fields kept in flash cache with schedules
+cachedMetadata = ('timestamp', 'timestamp_offset', 'valid_until', 'channels', 'fetch_url')
 cyclesUntilRequest = 20
 rtcSynced = False
 bootTimestampSynced = False
 
+# Server request interval: 18-20 program cycles of 15 seconds, backed off when schedule is not changing
+pollPlanner = pollplanner.PollPlanner(270, pollIntervalMax, 30)
+
 # Helper functions
 
 def syncClock(timestamp,diff):
@@ -189,16 +212,45 @@ def syncClock(timestamp,diff):
     
     return rtcSynced
 
+# NTP time is counted from the device epoch (2000 on rp2 firmware), but RTC is kept in Unix
+# time like the server timestamps. Cached schedule is used only if NTP time is inside it.
+def syncClockNtp(metadata):
+    try:
+        import ntptime
+        unixTime = ntptime.time() + (946684800 if gmtime(0)[0] == 2000 else 0)
+    except Exception as e:
+        consoleLog("Could not sync RTC from NTP: {}".format(e))
+        return False
+    
+    if not int(metadata['timestamp']) <= unixTime < int(metadata['valid_until']):
+        consoleLog("NTP time is outside cached schedule, RTC not synced")
+        return False
+    consoleLog("RTC synced from NTP")
+    return syncClock(unixTime, unixTime - time())
+
+# Take schedules loaded from flash cache in use and control relays right away
+def useCachedSchedule(metadata, schedules):
+    global controlsJson,channelSchedules,lastRequest,rtcSynced,jsonValidUntil,apiEndPoint,deviceChannels,getControlsInit,controlsReady,cachedSchedule
+    controlsJson = {'metadata': metadata}
+    channelSchedules = schedules
+    deviceChannels = int(metadata['channels'])
+    lastRequest = int(metadata['timestamp'])
+    jsonValidUntil = int(metadata['valid_until'])
+    apiEndPoint = metadata['fetch_url']
+    getControlsInit = True
+    rtcSynced = True
+    controlsReady = False
+    cachedSchedule = None
+    consoleLog("Using cached schedule, valid until {}".format(jsonValidUntil))
+    doControls()
+    planControls()
+
 def controlSwitch(switchId, setState):
-    switch = str('relay{}'.format(switchId))
-    if setState == True: 
-        control = switch.on()
-        print(control)
-        exec(control)
-    else:
-        control = switch.off()
-        print(control)
-        exec(control)
+    if switchId < 0 or switchId >= len(relayBank):
+        consoleLog("Unknown switch id {}".format(switchId))
+        return False
+    relayBank.set(switchId, setState)
+    return True
         
 def consoleLog(message):
     time = getLocalTime()
@@ -210,6 +262,20 @@ def consoleLogContinueline(message):
     print("[{:02d}:{:02d}:{:02d}]".format(time[3],time[4],time[5]),end=" ")
     print('{}'.format(message),end=" ")
 
+def connectionChanged(oldState, newState):
+    consoleLog("Wifi: {} -> {}".format(connectionmanager.STATE_NAMES[oldState], connectionmanager.STATE_NAMES[newState]))
+
+# Advance wifi connection state machine. Timer is re-armed after each tick by connection state,
+# so ticks are frequent only while connecting.
+def connectionTick(Timer):
+    try:
+        connectionmanager.tick()
+    finally:
+        armConnectionTimer()
+
+def armConnectionTimer():
+    connectionTimer.init(mode=Timer.ONE_SHOT, period=connectionmanager.tick_interval(), callback=connectionTick)
+
 def getLocalTime():
     global offset
     return gmtime(time() + int(offset))
@@ -217,7 +283,7 @@ def getLocalTime():
 
 # Service control functions
 def updateStatus():
-    global wifi, getControlsInit, jsonValidUntil
+    global getControlsInit, jsonValidUntil
     
     # Micropython health checks
     # Collect garbages
@@ -230,14 +296,9 @@ def updateStatus():
     message = "Memory: free:{}, alloc:{}".format(gc.mem_free(), gc.mem_alloc())
     consoleLog(message)
     
-    # If device is not connected to wifi-network, try to connect       
+    # Wifi-connection is handled in background by connection manager
     if not connectionmanager.wlan_sta.isconnected():
-        
-        consoleLog("No internet connection, trying to connect")
-        wifi = connectionmanager.get_connection(profiles)
-        
-        if not connectionmanager.wlan_sta.isconnected():
-            consoleLog("Could not connect")
+        consoleLog("No internet connection, connection state: {}".format(connectionmanager.STATE_NAMES[connectionmanager.state]))
             
     else:
         consoleLog("Network connected")
@@ -257,10 +318,10 @@ def updateStatus():
         machine.reset()
         
 def getControls():
-    global controlsJson,lastRequest,rtcSynced,offset,jsonValidUntil,apiEndPoint,lastRequestCode,deviceChannels,getControlsInit,controlsReady,cyclesUntilRequest,mainCycleCounter
+    global controlsJson,channelSchedules,lastRequest,rtcSynced,offset,jsonValidUntil,apiEndPoint,lastRequestCode,deviceChannels,getControlsInit,controlsReady,cyclesUntilRequest,mainCycleCounter,cachedSchedule
     
-    # If controller is in ap-mode there is no internet connection, not worth trying to get new JSON..
-    if connectionmanager.wlan_ap.isconnected():
+    # If wifi is not connected (access point only) there is no internet connection, not worth trying to get new JSON..
+    if not connectionmanager.wlan_sta.isconnected():
         consoleLog("No internet connection, JSON request not possible.")
         return
     
@@ -268,19 +329,38 @@ def getControls():
        
     consoleLog("Get JSON from {}".format(urlToCall))
     
-    # JSON-request 
+    # JSON-request, round-trip time until response headers is recorded for telemetry
+    requestStart = ticks_ms()
     try:
         try:
             resp = requests.get(urlToCall, timeout=8, json=True)
         except:
             consoleLog("Error! Request failed")
+            connectionmanager.record_request(None)
+            pollPlanner.update(0)
+            planRequest()
+            return
         
+        connectionmanager.record_request(ticks_diff(ticks_ms(), requestStart))
+        requestStart = None
+        pollPlanner.update(resp.status_code, pollplanner.retryAfter(resp.headers))
         if resp.status_code == 200:
-            controlsJson = resp.json()
+            # Parse response from socket in small pieces straight to channel schedules, only metadata is kept from JSON
+            builder = schedule.ControlsBuilder()
+            jsonstream.parse(resp.raw, builder.value)
             lastRequestCode = resp.status_code
             resp.close()
+            channelSchedules = builder.finish()
+            controlsJson = {'metadata': builder.metadata}
+            builder = None
+            gc.collect()
             consoleLog('Control data requested succesfully. Code 200.')
             
+            # Keep schedules for the next boot, written to flash by storage flush
+            metadata = controlsJson['metadata']
+            scheduleStore.update(schedule.pack({key: metadata[key] for key in cachedMetadata if key in metadata}, channelSchedules))
+            cachedSchedule = None
+            
             # Check RTC
             try:
                 # Check if RTC-time is +- 1 second from json-timestamp. If difference is more, update RTC-time from current json.
@@ -335,16 +415,27 @@ def getControls():
             resp.close()
             
         controlsReady = True
-        cyclesUntilRequest = random.randrange(18,20)
-        mainCycleCounter = 0
+        planRequest()
         #print('Server request done. ', requestInfo);
            
     # General error catch with nothing inside
     except:
         consoleLog("Unknown error with request")
+        if requestStart is not None:
+            connectionmanager.record_request(None)
+        pollPlanner.update(0)
+        planRequest()
+
+# Plan next request by schedule validity and last server responses. Without wifi request is
+# not planned, it is tried again on the next cycle.
+def planRequest():
+    global cyclesUntilRequest,mainCycleCounter
+    validUntil = jsonValidUntil if getControlsInit else None
+    cyclesUntilRequest = max(pollPlanner.next(validUntil, time()) // 15, 1)
+    mainCycleCounter = 0
 
 def doControls():
-    global controlsJson,rtcSynced,jsonValidUntil,doControlsInit,channelLastControlTimeStamps
+    global channelSchedules,rtcSynced,jsonValidUntil,doControlsInit,channelLastControlTimeStamps
     
     if not rtcSynced:
         consoleLog('RTC out of sync, control-loop not possible')
@@ -352,82 +443,59 @@ def doControls():
     
     # Control relays
         
-    # If there are more than 0 hour left on JSON, do controls based on it
-    if doControlsInit == True:
-        
-        consoleLog("Executing schedule loop")
-        
-        # Check if current timestamp is past next control timestamp and doing controls
-        # Get current timestamp from rtc and loop through channels
-        currentUnixTime = int(mktime(gmtime()))
-        for channel in controlsJson['controls']:
-            if channel['id']:
-                
-                # Loop through schedules
-                switchId = int(channel['id']) - 1
-                for scheduleEntry in channel['schedules']:
-                    if scheduleEntry['timestamp']:
-                        
-                        # If current timestamp is greater or equal than schedule entrys timestamp then check if control already done
-                        scheduleTimestamp = int(scheduleEntry['timestamp'])
-                        channelUpdated = int(channel['updated'])
-                        if currentUnixTime >= scheduleTimestamp:
-                            
-                            if scheduleTimestamp > channelLastControlTimeStamps[switchId]:
-                                consoleLog("Passed uncontrolled schedule timestamp, updating relay state")
-                                
-                                # Control switch and update last control timestamp
-                                controlState = int(scheduleEntry['state'])
-                                if controlState == 1:
-                                    control = "relay{}.on()".format(switchId)
-                                    exec(control)
-                                elif controlState == 0:
-                                    control = "relay{}.off()".format(switchId)
-                                    exec(control)
-                                
-                                channelLastControlTimeStamps[switchId] = scheduleTimestamp
-                                print("           Channel {},".format(switchId), "state: {}".format(controlState))
-
-                        # If channel settings changed after last control then set switch to current state
-                        elif channelUpdated > channelLastControlTimeStamps[switchId]:
-                            consoleLog('Switch id {} user settings changed. Controlling to current state.'.format(switchId));
-                            
-                            controlState = channel['state']
-                            if controlState == 1:
-                                control = "relay{}.on()".format(switchId)
-                                exec(control)
-                            elif controlState == 0:
-                                control = "relay{}.off()".format(switchId)
-                                exec(control)
-                            
-                            channelLastControlTimeStamps[switchId] = currentUnixTime
-                            print("           Channel {},".format(switchId), "state: {}".format(controlState))
-
-                            
-    else:
+    currentUnixTime = int(mktime(gmtime()))
+    
+    # Relay pins lose their state on reboot, so on the first run all relays are set to current
+    # states. Last control timestamps restored from flash are kept, so transitions and user
+    # setting changes after them are still handled by the schedule loop below.
+    if doControlsInit == False:
         consoleLog("Initializing relays to current states")
         
-        currentUnixTime = int(mktime(gmtime()))
-        for channel in controlsJson['controls']:
-            if channel['id']:
+        for channel in channelSchedules:
                 
-                # Loop through channels
-                switchId = int(channel['id']) - 1
-                controlState = int(channel['state'])
-                if controlState == 1:
-                    control = "relay{}.on()".format(switchId)
-                    exec(control)
-                elif controlState == 0:
-                    control = "relay{}.off()".format(switchId)
-                    exec(control)
-                            
+            # Loop through channels
+            switchId = channel.switchId
+            controlState = channel.state
+            controlSwitch(switchId, controlState)
+            
+            if switchId not in channelLastControlTimeStamps:
                 channelLastControlTimeStamps[switchId] = currentUnixTime
-                print("           Channel {},".format(switchId), "state: {}".format(controlState))
+            print("           Channel {},".format(switchId), "state: {}".format(controlState))
 
-                
         doControlsInit = True
         print(channelLastControlTimeStamps)
+    
+    consoleLog("Executing schedule loop")
+    
+    # Check if current timestamp is past next pending control timestamp and doing controls
+    for channel in channelSchedules:
+        switchId = channel.switchId
+        
+        # If current timestamp is greater or equal than schedule entrys timestamp then control if not already done
+        entry = channel.due(currentUnixTime, channelLastControlTimeStamps.get(switchId, 0))
+        if entry:
+            consoleLog("Passed uncontrolled schedule timestamp, updating relay state")
+            
+            # Control switch and update last control timestamp
+            scheduleTimestamp, controlState = entry
+            controlSwitch(switchId, controlState)
+            
+            channelLastControlTimeStamps[switchId] = scheduleTimestamp
+            print("           Channel {},".format(switchId), "state: {}".format(controlState))
+
+        # If channel settings changed after last control then set switch to current state
+        if channel.pending() and channel.updated > channelLastControlTimeStamps.get(switchId, 0):
+            consoleLog('Switch id {} user settings changed. Controlling to current state.'.format(switchId));
+            
+            controlState = channel.state
+            controlSwitch(switchId, controlState)
+            
+            channelLastControlTimeStamps[switchId] = currentUnixTime
+            print("           Channel {},".format(switchId), "state: {}".format(controlState))
 
+    # Keep last control timestamps for the next boot, written to flash by storage flush if changed
+    controlStore.update(json.dumps(channelLastControlTimeStamps).encode())
+    
     return True
             
     # If JSON data is expired, try failsafe. If not set, set all relays to 0
@@ -441,8 +509,7 @@ def doControls():
     #                hour = "{:02d}".format(hour)
     #                relays = data[hour]
     #                for item in relays:
-    #                    control = "{}.on()".format(item)
-    #                    exec(control)
+    #                    controlSwitch(relayBank.index(item), 1)
     #                    print("           Failsafe-mode: {} on".format(item))
     #            
                 # Set RGB to cyan
@@ -470,7 +537,30 @@ def doControls():
 
     
 
+# Arm control timer for the next pending schedule timestamp of all channels. Timer is
+# re-planned after each control and after each request, so schedule is not polled.
+def planControls():
+    controlTimer.deinit()
+    
+    nextTimestamp = None
+    for channel in channelSchedules:
+        channelTimestamp = channel.nextTimestamp()
+        if channelTimestamp is not None and (nextTimestamp is None or channelTimestamp < nextTimestamp):
+            nextTimestamp = channelTimestamp
+    
+    if nextTimestamp is None:
+        consoleLog("No pending schedule entries, control timer not set")
+        return
+    
+    toNextControl = max(nextTimestamp - time(), 0)
+    consoleLog("Set relay control timer ({} seconds)".format(toNextControl))
+    controlTimer.init(mode=Timer.ONE_SHOT, period=toNextControl * 1000 + 500, callback=doControlsTimer)
+
 # Timer functions                
+def doControlsTimer(Timer):
+    doControls()
+    planControls()
+
 def runProgram(Timer):
     global rtcSynced, mainCycleCounter, cyclesUntilRequest, getControlsInit, controlsReady
     
@@ -481,9 +571,11 @@ def runProgram(Timer):
         # Update time
         updateStatus()
         
-        # Do controls
+        # Do controls after request, later controls are executed by control timer
         if controlsReady == True:
             doControls()
+            planControls()
+            controlsReady = False
           
     else:
         consoleLog('Initial controls data not fetched from server, impossible to do controls');
@@ -492,14 +584,54 @@ def runProgram(Timer):
     if mainCycleCounter >= cyclesUntilRequest:
         controlsReady = False
         getControls()
+        
+        # If request failed but there is cached schedule, sync RTC from NTP to be able to use it
+        if cachedSchedule and not rtcSynced and connectionmanager.wlan_sta.isconnected():
+            if syncClockNtp(cachedSchedule[0]):
+                useCachedSchedule(*cachedSchedule)
 
     mainCycleCounter += 1
+    
+    # Write changed persistent data to flash
+    try:
+        controlStore.flush()
+        scheduleStore.flush()
+    except OSError as e:
+        consoleLog("Could not write persistent data: {}".format(e))
            
     
 # Start the program
 # RTC is probably not yet in time, but we save timestamp here and add add diff once time is synced
 bootTimestamp = mktime(gmtime())
 
+# Connect wifi in background, connection doesn't block controls
+connectionmanager.add_listener(connectionChanged)
+connectionmanager.start(profiles)
+armConnectionTimer()
+
+# Restore last control timestamps from flash
+controlStore = storage.Storage('controls', storageFlushInterval)
+if controlStore.data:
+    try:
+        for switchId, timestamp in json.loads(controlStore.data).items():
+            channelLastControlTimeStamps[int(switchId)] = timestamp
+    except ValueError:
+        print("Could not load control timestamps")
+
+# Load last schedules from flash, so relays can be controlled before the first request succeeds.
+# If RTC has kept its time over the reboot, cached schedules are used right away.
+scheduleStore = storage.Storage('schedule', storageFlushInterval)
+if scheduleStore.data:
+    try:
+        metadata, schedules = schedule.unpack(scheduleStore.data)
+        consoleLog("Loaded cached schedule")
+        if int(metadata['timestamp']) <= time() < int(metadata['valid_until']):
+            useCachedSchedule(metadata, schedules)
+        elif time() < int(metadata['valid_until']):
+            cachedSchedule = (metadata, schedules)
+    except (ValueError, KeyError) as e:
+        print("Could not load cached schedule: {}".format(e))
+
 # Start program loop timer
 programTimer.init(mode=Timer.PERIODIC, period = 15 * 1000, callback=runProgram)
 
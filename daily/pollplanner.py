@@ -0,0 +1,53 @@
+import random
+
+# Plans the delay until the next request to the control server. Normally requests are made
+# at base interval. Every 304 (nothing changed), 429 or 425 answer or failed request in a
+# row doubles the interval up to the maximum, and Retry-After from the server is always
+# respected. When the schedule is about to expire, interval is kept at base so new schedule
+# is fetched in time. Random jitter spreads the requests of many devices.
+
+# Code 0 is a failed request (timeout, DNS, connection or parse error)
+BACKOFF_CODES = (0, 304, 425, 429)
+
+# Retry-After from response headers in seconds, 0 if missing or given as a date
+def retryAfter(headers):
+    for name in headers:
+        if name.lower() == 'retry-after':
+            try:
+                return max(int(headers[name]), 0)
+            except ValueError:
+                return 0
+    return 0
+
+class PollPlanner:
+    def __init__(self, interval=90, maxInterval=900, jitter=30, expiryWindow=3*3600):
+        self.interval = interval
+        self.maxInterval = max(maxInterval, interval)
+        self.jitter = jitter
+        self.expiryWindow = expiryWindow
+        self.backoff = 0
+        self.retryAfter = 0
+
+    # Update state from request result, code 0 if request failed
+    def update(self, code, retryAfter=0):
+        if code in BACKOFF_CODES:
+            if self.interval << self.backoff < self.maxInterval:
+                self.backoff += 1
+        else:
+            self.backoff = 0
+        self.retryAfter = retryAfter
+
+    # Seconds until next request. validUntil and now are unix times, validUntil None if
+    # there is no valid schedule.
+    def next(self, validUntil=None, now=0):
+        delay = min(self.interval << self.backoff, self.maxInterval)
+        if validUntil is not None:
+            toWindow = validUntil - self.expiryWindow - now
+            if toWindow <= 0:
+                delay = self.interval
+            elif toWindow < delay:
+                delay = max(toWindow, self.interval)
+
+        # Jitter grows with the interval, so backed off devices don't get synchronized
+        delay += random.randrange(max(self.jitter, delay // 4))
+        return max(delay, self.retryAfter)
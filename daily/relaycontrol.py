@@ -0,0 +1,45 @@
+# Channel to relay pin mapping. Built once at boot, relays are controlled
+# directly through Pin objects. Current states are kept in bytearray, so
+# pins are written only when state actually changes.
+
+class RelayBank:
+    def __init__(self, pins, nameOffset=1):
+        self.pins = tuple(pins)
+        self.states = bytearray(len(self.pins))
+        for i in range(len(self.pins)):
+            self.states[i] = self.pins[i].value()
+        
+        # Relay names used in failsafe.json (eg. relay1 -> channel index 0)
+        self.names = {}
+        for i in range(len(self.pins)):
+            self.names['relay{}'.format(i + nameOffset)] = i
+
+    def __len__(self):
+        return len(self.pins)
+
+    # Returns channel index of named relay or None if relay is not found
+    def index(self, name):
+        return self.names.get(name)
+
+    # Set state of single channel (index from 0), returns True if pin was toggled
+    def set(self, i, state, force=False):
+        state = 1 if state else 0
+        if self.states[i] == state and not force:
+            return False
+        self.pins[i].value(state)
+        self.states[i] = state
+        return True
+
+    # Apply state vector (one state per channel from index 0). Only pins which
+    # state differ from current state are toggled. Returns count of toggled pins.
+    def apply(self, states, count=None, force=False):
+        if count is None or count > len(self.pins):
+            count = min(len(states), len(self.pins))
+        changed = 0
+        for i in range(count):
+            if self.set(i, states[i], force):
+                changed += 1
+        return changed
+
+    def value(self, i):
+        return self.states[i]
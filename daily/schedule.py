@@ -0,0 +1,139 @@
+from array import array
+import json
+try:
+    import ustruct as struct
+except:
+    import struct
+
+# Control schedule of one channel, parsed once after request. Schedule entries are kept
+# in arrays sorted by timestamp and cursor points to the next pending transition, so
+# each control cycle only compares current time with the entry under cursor.
+
+class ChannelSchedule:
+    def __init__(self, switchId, state, updated, entries):
+        entries.sort()
+        self.switchId = switchId
+        self.state = state
+        self.updated = updated
+        self.timestamps = array('L', [entry[0] for entry in entries])
+        self.states = bytearray([entry[1] for entry in entries])
+        self.cursor = 0
+
+    def pending(self):
+        return self.cursor < len(self.timestamps)
+
+    # Timestamp of the next pending transition or None if schedule has ended
+    def nextTimestamp(self):
+        if self.cursor < len(self.timestamps):
+            return self.timestamps[self.cursor]
+        return None
+
+    # Move cursor past all transitions which have passed. Returns (timestamp, state) of the
+    # latest passed transition not yet controlled (newer than lastControl), otherwise None.
+    def due(self, now, lastControl):
+        result = None
+        while self.cursor < len(self.timestamps) and self.timestamps[self.cursor] <= now:
+            if self.timestamps[self.cursor] > lastControl:
+                result = self.cursor
+            self.cursor += 1
+        if result is None:
+            return None
+        return self.timestamps[result], self.states[result]
+
+
+# Builds channel schedules from values streamed by jsonstream parser, so the v2 response
+# is never held in memory as a whole. Channel and schedule entry are completed when the
+# parser moves to the next array index.
+class ControlsBuilder:
+    def __init__(self):
+        self.metadata = {}
+        self.schedules = []
+        self.channelIndex = None
+        self.channel = {}
+        self.entries = []
+        self.entryIndex = None
+        self.entry = {}
+
+    # Handler for jsonstream
+    def value(self, path, value):
+        if len(path) == 2 and path[0] == 'metadata':
+            self.metadata[path[1]] = value
+        elif len(path) >= 3 and path[0] == 'controls':
+            if path[1] != self.channelIndex:
+                self._finishChannel()
+                self.channelIndex = path[1]
+            if len(path) == 3:
+                if path[2] in ('id', 'state', 'updated'):
+                    self.channel[path[2]] = value
+            elif len(path) == 5 and path[2] == 'schedules':
+                if path[3] != self.entryIndex:
+                    self._finishEntry()
+                    self.entryIndex = path[3]
+                if path[4] in ('timestamp', 'state'):
+                    self.entry[path[4]] = value
+
+    def _finishEntry(self):
+        if self.entry.get('timestamp'):
+            self.entries.append((int(self.entry['timestamp']), int(self.entry['state'])))
+        self.entry = {}
+        self.entryIndex = None
+
+    def _finishChannel(self):
+        self._finishEntry()
+        channel = self.channel
+        if channel.get('id'):
+            self.schedules.append(ChannelSchedule(int(channel['id']) - 1, int(channel['state']), int(channel['updated']), self.entries))
+        self.channel = {}
+        self.entries = []
+
+    def finish(self):
+        self._finishChannel()
+        return self.schedules
+
+
+# Channel schedules in binary form for the flash cache: header (magic, metadata length, channel
+# count), metadata as JSON and for each channel switch id, state, updated, entry count, entry
+# timestamps and entry states.
+CACHE_HEADER = '<4sHB'
+CACHE_CHANNEL = '<BBIH'
+CACHE_MAGIC = b'PDC1'
+
+def pack(metadata, schedules):
+    metadataJson = json.dumps(metadata).encode()
+    data = bytearray(struct.pack(CACHE_HEADER, CACHE_MAGIC, len(metadataJson), len(schedules)))
+    data += metadataJson
+    for channel in schedules:
+        count = len(channel.timestamps)
+        data += struct.pack(CACHE_CHANNEL, channel.switchId, channel.state, channel.updated, count)
+        data += struct.pack('<{}I'.format(count), *channel.timestamps)
+        data += channel.states
+    return bytes(data)
+
+# Returns (metadata, schedules), raises ValueError if data is not a valid cache
+def unpack(data):
+    headerSize = struct.calcsize(CACHE_HEADER)
+    if len(data) < headerSize:
+        raise ValueError('Schedule cache: truncated header')
+    magic, metadataLength, channels = struct.unpack(CACHE_HEADER, data[:headerSize])
+    if magic != CACHE_MAGIC:
+        raise ValueError('Schedule cache: unknown format')
+    pos = headerSize + metadataLength
+    metadata = json.loads(data[headerSize:pos].decode())
+    
+    channelSize = struct.calcsize(CACHE_CHANNEL)
+    schedules = []
+    for i in range(channels):
+        if len(data) < pos + channelSize:
+            raise ValueError('Schedule cache: truncated channel')
+        switchId, state, updated, count = struct.unpack(CACHE_CHANNEL, data[pos:pos + channelSize])
+        pos += channelSize
+        end = pos + count * 5
+        if len(data) < end:
+            raise ValueError('Schedule cache: truncated entries')
+        timestamps = struct.unpack('<{}I'.format(count), data[pos:pos + count * 4])
+        states = data[pos + count * 4:end]
+        pos = end
+        schedules.append(ChannelSchedule(switchId, state, updated, list(zip(timestamps, states))))
+    if pos != len(data):
+        raise ValueError('Schedule cache: wrong size')
+    return metadata, schedules
@@ -0,0 +1,72 @@
+try:
+    import ustruct as struct
+except:
+    import struct
+from ubinascii import crc32
+from time import ticks_ms, ticks_diff
+
+# Flash storage with RAM write-back buffer. Data is kept in RAM and written to flash only if
+# it has changed and flush interval has passed since the last write, so frequent updates are
+# coalesced into a few writes per hour (first write after boot is done right away). Two files
+# are written in turns and each has sequence number and crc32, so a broken write never
+# destroys the previous copy. On load the newest file with valid crc is used.
+
+HEADER = '<4sII'
+MAGIC = b'PST1'
+
+class Storage:
+    def __init__(self, name, flushInterval=600):
+        self.files = (name + '.a', name + '.b')
+        self.flushInterval = flushInterval * 1000
+        self.data = None
+        self.dirty = False
+        self.sequence = 0
+        self.writes = 0
+        self.lastFlush = None
+        self._load()
+
+    # Read file, returns (sequence, data) or None if file is missing or broken
+    def _read(self, fileName):
+        try:
+            with open(fileName, 'rb') as file:
+                header = file.read(struct.calcsize(HEADER))
+                data = file.read()
+        except OSError:
+            return None
+        if len(header) != struct.calcsize(HEADER):
+            return None
+        magic, sequence, crc = struct.unpack(HEADER, header)
+        if magic != MAGIC or crc32(data) != crc:
+            return None
+        return sequence, data
+
+    def _load(self):
+        for fileName in self.files:
+            result = self._read(fileName)
+            if result and (self.data is None or result[0] > self.sequence):
+                self.sequence, self.data = result
+
+    # Update data in RAM, marked dirty only if data has changed
+    def update(self, data):
+        if data != self.data:
+            self.data = bytes(data)
+            self.dirty = True
+
+    # Write data to flash if it is dirty and flush interval has passed (or force is set).
+    # Returns True if data was written.
+    def flush(self, force=False):
+        if not self.dirty:
+            return False
+        if not force and self.lastFlush is not None and ticks_diff(ticks_ms(), self.lastFlush) < self.flushInterval:
+            return False
+
+        # Write over the older file, newer one is left untouched
+        sequence = self.sequence + 1
+        with open(self.files[sequence % 2], 'wb') as file:
+            file.write(struct.pack(HEADER, MAGIC, sequence, crc32(self.data)))
+            file.write(self.data)
+        self.sequence = sequence
+        self.dirty = False
+        self.writes += 1
+        self.lastFlush = ticks_ms()
+        return True
@@ -0,0 +1,207 @@
+try:
+    import usocket as socket
+except:
+    import socket
+
+# Minimal HTTP/1.1 client which keeps the connection to the server open between requests,
+# so TCP and TLS handshakes are not repeated on every poll. If the server has closed the
+# idle connection, request is sent again once over a new connection. Response body is
+# read from the socket with readinto (Content-Length, chunked or until connection closes).
+
+# Bodies shorter than this are read away on close to keep the connection usable
+DRAIN_LIMIT = 1024
+
+def parseUrl(url):
+    scheme, _, rest = url.partition('://')
+    if scheme not in ('http', 'https') or not rest:
+        raise ValueError('Unsupported url: {}'.format(url))
+    host, _, path = rest.partition('/')
+    port = 443 if scheme == 'https' else 80
+    if ':' in host:
+        host, port = host.split(':', 1)
+        port = int(port)
+    return scheme, host, port, '/' + path
+
+class Response:
+    def __init__(self, client, sock, method):
+        self.client = client
+        self.sock = sock
+        self.method = method
+        self.status_code = 0
+        self.reason = ''
+        self.headers = {}
+        self.keepAlive = True
+        self.chunked = False
+        # Bytes left in body (or in current chunk), None if body ends when connection closes
+        self.length = 0
+        self.done = False
+
+    # Body is read from response itself, same as urequests raw-stream
+    @property
+    def raw(self):
+        return self
+
+    def _readHeaders(self):
+        line = self.sock.readline()
+        if not line:
+            raise OSError('Connection closed by server')
+        parts = line.split(None, 2)
+        self.status_code = int(parts[1])
+        if len(parts) > 2:
+            self.reason = parts[2].strip().decode()
+        if parts[0] == b'HTTP/1.0':
+            self.keepAlive = False
+
+        # Header names are stored in lower case
+        while True:
+            line = self.sock.readline()
+            if not line or line == b'\r\n':
+                break
+            name, _, value = line.decode().partition(':')
+            self.headers[name.strip().lower()] = value.strip()
+
+        if 'close' in self.headers.get('connection', '').lower():
+            self.keepAlive = False
+
+        if self.method == 'HEAD' or self.status_code in (204, 304) or self.status_code < 200:
+            self.done = True
+        elif 'chunked' in self.headers.get('transfer-encoding', '').lower():
+            self.chunked = True
+        elif 'content-length' in self.headers:
+            self.length = int(self.headers['content-length'])
+            self.done = self.length == 0
+        else:
+            self.length = None
+            self.keepAlive = False
+
+    def _nextChunk(self):
+        line = self.sock.readline()
+        self.length = int(line.split(b';')[0].strip(), 16)
+        if self.length == 0:
+            # Skip trailers
+            while True:
+                line = self.sock.readline()
+                if not line or line == b'\r\n':
+                    break
+            self.done = True
+
+    def readinto(self, buffer):
+        if self.done:
+            return 0
+        if self.chunked and self.length == 0:
+            self._nextChunk()
+            if self.done:
+                return 0
+
+        view = memoryview(buffer)
+        if self.length is not None and self.length < len(buffer):
+            view = view[:self.length]
+        n = self.sock.readinto(view)
+        if not n:
+            if self.length is not None:
+                raise OSError('Connection closed before end of body')
+            self.done = True
+            return 0
+
+        if self.length is not None:
+            self.length -= n
+            if self.length == 0:
+                if self.chunked:
+                    # CRLF after chunk data
+                    self.sock.readline()
+                else:
+                    self.done = True
+        return n
+
+    # Read rest of a short body so that connection can be used for the next request,
+    # otherwise connection is closed.
+    def close(self):
+        if self.sock is None:
+            return
+        if not self.done and self.keepAlive:
+            buffer = bytearray(64)
+            drained = 0
+            try:
+                while not self.done and drained < DRAIN_LIMIT:
+                    drained += self.readinto(buffer)
+            except (OSError, ValueError):
+                self.keepAlive = False
+        if not self.done or not self.keepAlive:
+            self.client.close()
+        self.sock = None
+
+class HTTPClient:
+    def __init__(self, timeout=8):
+        self.timeout = timeout
+        self.sock = None
+        self.address = None
+        self.connects = 0
+        self.requests = 0
+
+    def _connect(self, scheme, host, port):
+        self.close()
+        addr = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0]
+        sock = socket.socket(addr[0], socket.SOCK_STREAM, addr[2])
+        try:
+            sock.settimeout(self.timeout)
+            sock.connect(addr[-1])
+            if scheme == 'https':
+                try:
+                    import ussl as ssl
+                except:
+                    import ssl
+                sock = ssl.wrap_socket(sock, server_hostname=host)
+        except:
+            sock.close()
+            raise
+        self.sock = sock
+        self.address = (scheme, host, port)
+        self.connects += 1
+
+    def close(self):
+        if self.sock:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+        self.address = None
+
+    def _send(self, method, host, port, path, headers, body):
+        if port in (80, 443):
+            request = '{} {} HTTP/1.1\r\nHost: {}\r\n'.format(method, path, host)
+        else:
+            request = '{} {} HTTP/1.1\r\nHost: {}:{}\r\n'.format(method, path, host, port)
+        if headers:
+            for name in headers:
+                request += '{}: {}\r\n'.format(name, headers[name])
+        if body is not None:
+            request += 'Content-Length: {}\r\n'.format(len(body))
+        self.sock.write(request.encode() + b'\r\n')
+        if body is not None:
+            self.sock.write(body)
+
+    # Send request and read status and headers, body is left in the socket to be read from response
+    def request(self, method, url, headers=None, body=None):
+        scheme, host, port, path = parseUrl(url)
+        while True:
+            reused = self.sock is not None and self.address == (scheme, host, port)
+            if not reused:
+                self._connect(scheme, host, port)
+            try:
+                self._send(method, host, port, path, headers, body)
+                resp = Response(self, self.sock, method)
+                resp._readHeaders()
+                self.requests += 1
+                return resp
+            except (OSError, ValueError, IndexError):
+                self.close()
+                # Server may have closed the idle connection, try once more with new one
+                if not reused:
+                    raise
+
+    def get(self, url, headers=None):
+        return self.request('GET', url, headers)
+
+    def head(self, url, headers=None):
+        return self.request('HEAD', url, headers)
@@ -4,34 +4,40 @@
 #                  
 # Requirements:    Tested with Pico W Micropython v1.19.1-994-ga4672149b
 #
-# Known issues:    Web server gets stuck when losing wifi connection
+# Known issues:    -
 #
 ############################################################################
 
 VERSION = "Micropython-1.0-rc2"
 
 # Import network modules
-try:
-    import urequests as requests
-except:
-    import requests
 try:
     import usocket as socket
 except:
     import socket
+try:
+    import uasyncio as asyncio
+except:
+    import asyncio
 
 # Import custom python modules
 import connectionmanager
 import webpages
+import relaycontrol
+import schedule
+import jsonstream
+import storage
+import httpclient
+import pollplanner
     
 # Import libs to read and convert data
 import json
-from ubinascii import hexlify
-import random
+from ubinascii import hexlify, crc32
+import os
 from math import floor
 
 #import time
-from time import sleep, mktime, localtime
+from time import sleep, mktime, localtime, gmtime, ticks_ms, ticks_diff
 
 # Import pin-control
 from machine import Pin, Timer
@@ -49,6 +55,14 @@ programTimer = Timer()
 controlTimer = Timer()
 requestTimer = Timer()
 
+# Web server
+serverPort = 80
+serverMaxClients = 4
+serverTimeout = 5
+serverCheckInterval = 5
+serverStaticMaxAge = 86400
+serverPageBuffer = 512
+
 # Onboard led
 onboard = Pin("LED", Pin.OUT, value=0)
 
@@ -57,18 +71,17 @@ np = NeoPixel(machine.Pin(13), 1)
 np[0] = (255, 0, 0)
 np.write()
 
-# Relay pins
-relay1 = Pin(21, Pin.OUT)
-relay2 = Pin(20, Pin.OUT)
-relay3 = Pin(19, Pin.OUT)
-relay4 = Pin(18, Pin.OUT)
-relay5 = Pin(17, Pin.OUT)
-relay6 = Pin(16, Pin.OUT)
-relay7 = Pin(15, Pin.OUT)
-relay8 = Pin(14, Pin.OUT)
+# Persistent data is written to flash at most once per interval (seconds)
+storageFlushInterval = 600
+
+# Maximum seconds between server requests when schedule has not changed (can be overridden with Poll_interval_max in config.json)
+pollIntervalMax = 900
+
+# Check schedule version with HEAD-request before downloading it (can be enabled with Version_check in config.json)
+versionCheck = False
 
-# Tuple for web interface (add all the relays above for proper functionality)
-relays = (relay1, relay2, relay3, relay4, relay5, relay6, relay7, relay8)
+# Relay pins for channels 1-8 (can be overridden with Relay_pins list in config.json)
+relayPins = (21, 20, 19, 18, 17, 16, 15, 14)
 
 # Get config from json 
 try:
@@ -81,6 +94,22 @@ try:
         # Get failsafe-setting
         failsafe = data['Failsafe']
         
+        # Get relay pins
+        if 'Relay_pins' in data:
+            relayPins = data['Relay_pins']
+        
+        # Get maximum server request interval
+        if 'Poll_interval_max' in data:
+            pollIntervalMax = data['Poll_interval_max']
+        
+        # Get version check setting
+        if 'Version_check' in data:
+            versionCheck = data['Version_check']
+        
+        # Get minimum interval (seconds) between flash writes
+        if 'Storage_flush_interval' in data:
+            storageFlushInterval = data['Storage_flush_interval']
+        
         # Get wifi-information to dictionary
         profiles = {}
         try:
@@ -108,6 +137,11 @@ except:
     print("Error! Could not retrieve configs, rebooting..")
     machine.reset()
     
+# Relays, channel to pin mapping is built once here. Tuple of pins is used in web interface.
+relayBank = relaycontrol.RelayBank([Pin(pin, Pin.OUT) for pin in relayPins])
+relays = relayBank.pins
+controlStates = bytearray(len(relayBank))
+
 # Get device mac from wifi adapter
 try:
     deviceMacHex = connectionmanager.wlan_sta.config('mac')
@@ -138,22 +172,30 @@ except:
         print("Error with device MAC, rebooting..")
         machine.reset()
 
-# Get wifi connection (Returns wlan_sta or wlan_ap)
-wifi = connectionmanager.get_connection(profiles)
-
 # Program state variables
 lastRequest = 0
+lastRequestCode = 0
 hoursLeftOnJson = 0
-doControlsTimerArmed = False
 getControlsTimerArmed = False
 rtcSynced = False
 bootTimestampSynced = False
+serverClients = 0
+
+# Validators of the last received schedule, sent back in conditional requests
+scheduleEtag = None
+scheduleLastModified = None
 
-# Empty list for webserver until first request is succeeded
-controlsJson = {}
+# Connection to the control server is kept open between requests
+httpClient = httpclient.HTTPClient(timeout=8)
+
+# Server request interval: 90 sec + random 0-30 sec, backed off when schedule is not changing
+pollPlanner = pollplanner.PollPlanner(90, pollIntervalMax, 30)
+
+# Schedule converted from JSON, None until first request is succeeded or cached schedule is loaded
+controlSchedule = None
     
 def updateStatus():
-    global doControlsTimerArmed,hoursLeftOnJson,controlsJson,wifi
+    global hoursLeftOnJson,controlSchedule
     
     # Micropython health checks
     # Collect garbages
@@ -164,16 +206,11 @@ def updateStatus():
     print("\n[{:02d}:{:02d}:{:02d}]".format(time[4],time[5],time[6]),end=" ")
     print("Memory: free:{}, alloc:{}".format(gc.mem_free(), gc.mem_alloc()))
            
-    # If device is not connected to wifi-network, try to connect       
+    # Wifi-connection is handled in background by connection manager
     if not connectionmanager.wlan_sta.isconnected():
         time = rtc.datetime() 
         print("[{:02d}:{:02d}:{:02d}]".format(time[4],time[5],time[6]),end=" ")
-        print("No internet connection, trying to connect")
-        
-        wifi = connectionmanager.get_connection(profiles)
-        if not connectionmanager.wlan_sta.isconnected():
-            print("[{:02d}:{:02d}:{:02d}]".format(time[4],time[5],time[6]),end=" ")
-            print("Could not connect")
+        print("No internet connection, connection state: {}".format(connectionmanager.STATE_NAMES[connectionmanager.state]))
             
     else:
         time = rtc.datetime() 
@@ -185,24 +222,12 @@ def updateStatus():
     if rtcSynced:
         
         # Calculate how many hours are left in JSON (if request is ok, should equal with hours_count - 1)
-        if controlsJson:
-            timeUnix = mktime(localtime())
-            requestWithOffset = int(controlsJson['Metadata']['Timestamp']) + int(controlsJson['Metadata']['Timestamp_offset'])
-            hoursCountSeconds = int(controlsJson['Metadata']['Hours_count']) * 3600
-            hoursLeftOnJson = floor(((requestWithOffset + hoursCountSeconds) - timeUnix) / 3600)
+        if controlSchedule:
+            updateHoursLeft()
             time = rtc.datetime()
             print("[{:02d}:{:02d}:{:02d}]".format(time[4],time[5],time[6]),end=" ")
             print('Control hours left in JSON: {}'.format(hoursLeftOnJson))
   
-        # Check if controls_timer is armed and arm if not, JSON is not required because function check if failsafe is set
-        if not doControlsTimerArmed:
-            toNextQuarter = secondsUntilNextQuarter()
-            time = rtc.datetime()
-            print("[{:02d}:{:02d}:{:02d}]".format(time[4],time[5],time[6]),end=" ")
-            print('Set relay control timer ({} seconds)'.format(toNextQuarter))
-            controlTimer.deinit()
-            controlTimer.init(mode=Timer.ONE_SHOT, period=toNextQuarter * 1000, callback=doControlsTimer)
-            doControlsTimerArmed = True
     else:
         time = rtc.datetime()
         print("[{:02d}:{:02d}:{:02d}]".format(time[4],time[5],time[6]),end=" ")
@@ -210,10 +235,11 @@ def updateStatus():
 
         
 def getControls():
-    global controlsJson,lastRequest,rtcSynced
+    global controlSchedule,lastRequest,rtcSynced,lastRequestCode,scheduleEtag,scheduleLastModified
     
-    # If controller is in ap-mode there is no internet connection, not worth trying to get new JSON..
-    if connectionmanager.wlan_ap.isconnected():
+    # If wifi is not connected (access point only) there is no internet connection, not worth trying to get new JSON..
+    if not connectionmanager.wlan_sta.isconnected():
+        time = rtc.datetime() 
         print("\n[{:02d}:{:02d}:{:02d}]".format(time[4],time[5],time[6]),end=" ")
         print('No internet connection, JSON request not possible.')
         return
@@ -227,26 +253,51 @@ def getControls():
     #If request already succesfully made once then add last response unix time to request and use fetch-url from JSON.
     #If RTC is not synced we do not add last_request because we want get new JSON from server to update rtc-time
     if lastRequest > 0 and rtcSynced:
-        fetchUrl = controlsJson['Metadata']['Fetch_url']
+        fetchUrl = controlSchedule.fetchUrl
         urlToCall = "{}?device_mac={}&last_request={}&client={}".format(fetchUrl,mac,lastRequest,VERSION)
        
     print(urlToCall)
     
-    # JSON-request 
+    # Conditional request: server answers 304 without body if schedule has not changed
+    requestHeaders = {}
+    if lastRequest > 0 and rtcSynced:
+        if scheduleEtag:
+            requestHeaders['If-None-Match'] = scheduleEtag
+        if scheduleLastModified:
+            requestHeaders['If-Modified-Since'] = scheduleLastModified
+    
+    # JSON-request, round-trip time until response headers is recorded for telemetry
+    requestStart = ticks_ms()
     try:
+        resp = None
+        if versionCheck and requestHeaders:
+            resp = checkVersion(urlToCall, requestHeaders)
         try:
-            resp = requests.get(urlToCall, timeout=8, json=True)
+            if resp is None:
+                resp = httpClient.get(urlToCall, requestHeaders)
         except:
             time = rtc.datetime() 
             print("[{:02d}:{:02d}:{:02d}]".format(time[4],time[5],time[6]),end=" ")
             print("Error! Trying fallback-url (",end="")
-            urlToCall = "{}?device_mac={}&last_request={}".format(fallbackUrl,deviceMac,lastRequest)
+            urlToCall = "{}?device_mac={}&last_request={}&client={}".format(fallbackUrl,mac,lastRequest,VERSION)
             print("{})".format(urlToCall))
-            resp = requests.get(urlToCall, timeout=8, json=True)
+            resp = httpClient.get(urlToCall)
         
+        lastRequestCode = resp.status_code
+        connectionmanager.record_request(ticks_diff(ticks_ms(), requestStart))
+        requestStart = None
+        pollPlanner.update(resp.status_code, pollplanner.retryAfter(resp.headers))
         if resp.status_code == 200:
-            controlsJson = resp.json()
+            scheduleEtag = resp.headers.get('etag')
+            scheduleLastModified = resp.headers.get('last-modified')
+            
+            # Parse response from socket in small pieces straight to compact schedule, whole JSON is never in memory
+            builder = schedule.ScheduleBuilder(len(relayBank))
+            jsonstream.parse(resp.raw, builder.value)
             resp.close()
+            controlSchedule = builder.finish()
+            builder = None
+            gc.collect()
             time = rtc.datetime() 
             print("\n[{:02d}:{:02d}:{:02d}]".format(time[4],time[5],time[6]),end=" ")
             print('Control data requested succesfully. Code 200.')
@@ -255,7 +306,7 @@ def getControls():
             try:
                 # Check if RTC-time is +- 1 second from json-timestamp. If difference is more, update RTC-time from current json.
                 timeUnix = int(mktime(localtime()))
-                timeWithOffset = int(controlsJson['Metadata']['Timestamp']) + int(controlsJson['Metadata']['Timestamp_offset'])
+                timeWithOffset = controlSchedule.timestamp + controlSchedule.timestampOffset
                 diff = timeWithOffset - timeUnix
                 if diff not in range(-1, 2):
                     time = rtc.datetime() 
@@ -275,11 +326,15 @@ def getControls():
             print("RTC synced: {}".format(rtcSynced))
             
             # Do controls right after new JSON
-            deviceChannels = int(controlsJson['Metadata']['Channels'])
-            lastRequest = int(controlsJson['Metadata']['Timestamp'])
+            deviceChannels = controlSchedule.channels
+            lastRequest = controlSchedule.timestamp
             time = rtc.datetime() 
             print("[{:02d}:{:02d}:{:02d}]".format(time[4],time[5],time[6]),end=" ")
             print('Channels to control: {}'.format(deviceChannels))
+            
+            # Save schedule for the next boot, written to flash by storage flush if changed
+            scheduleStore.update(schedule.pack(controlSchedule))
+            
             updateStatus()
             
             # Set RGB to blue if there's a succesfull request
@@ -287,6 +342,7 @@ def getControls():
             np.write()
             
             doControls(False)
+            planControls()
             
         elif resp.status_code == 400:
             time = rtc.datetime() 
@@ -319,12 +375,34 @@ def getControls():
         time = rtc.datetime() 
         print("[{:02d}:{:02d}:{:02d}]".format(time[4],time[5],time[6]),end=" ")
         print("ERROR!")
-
+        # Status reports failed request until the next response arrives
+        lastRequestCode = 0
+        pollPlanner.update(0)
+        if requestStart is not None:
+            connectionmanager.record_request(None)
+        # Response may be left half-read, don't reuse the connection
+        httpClient.close()
+
+
+# HEAD-request for checking if schedule has changed. Only headers are transferred, returns
+# response with code 304 if schedule is unchanged and None if full request is needed.
+def checkVersion(urlToCall, requestHeaders):
+    try:
+        resp = httpClient.head(urlToCall, requestHeaders)
+    except:
+        consoleLog("Version check failed")
+        return None
+    
+    # Server may ignore conditional headers in HEAD-request, then compare ETag here
+    if resp.status_code == 200 and scheduleEtag and resp.headers.get('etag') == scheduleEtag:
+        resp.status_code = 304
+    if resp.status_code == 304:
+        return resp
+    resp.close()
+    return None
 
 def doControls(timerInitiated):
-    global controlsJson,doControlsTimerArmed,rtcSynced,hoursLeftOnJson
-
-    doControlsTimerArmed = False
+    global controlSchedule,rtcSynced,hoursLeftOnJson
     
     if not rtcSynced:
         time = rtc.datetime() 
@@ -339,26 +417,24 @@ def doControls(timerInitiated):
     print("Update relay states")
         
     # If there are more than 0 hour left on JSON, do controls based on it
-    if controlsJson and hoursLeftOnJson > 0:
-        channels = int(controlsJson['Metadata']['Channels'])
+    if controlSchedule:
+        updateHoursLeft()
+    if controlSchedule and hoursLeftOnJson > 0:
+        slot = schedule.slot(time[4], time[5])
+        channels = min(controlSchedule.channels, len(relayBank))
         i = 0
-        relay = []
         while i < channels:
-            try:
-                result = controlsJson['Channel{}'.format(i + 1)]['{!s}'.format(hour)]
-                relay.append('relay{}'.format(i + 1))
-                print("           Channel {},".format(i + 1), "hour {}: {}".format(hour,result))
-                if result == '1':
-                    control = "{}.on()".format(relay[i])
-                    exec(control)
-                else:
-                    control = "{}.off()".format(relay[i])
-                    exec(control)
-                i += 1
-            except:
+            result = controlSchedule.get(i, slot)
+            if result is None:
                 print("Could not control relay {}".format(i + 1))
-                i += 1
-            controlError = 0
+                controlStates[i] = relayBank.value(i)
+            else:
+                print("           Channel {},".format(i + 1), "{:02d}:{:02d}: {}".format(slot // 4, slot % 4 * 15, result))
+                controlStates[i] = result
+            i += 1
+        
+        # Toggle only relays which state has changed
+        relayBank.apply(controlStates, channels)
         return True
             
     # If JSON data is expired, try failsafe. If not set, set all relays to 0
@@ -370,11 +446,13 @@ def doControls(timerInitiated):
                 with open("failsafe.json", "r") as jsonfile:
                     data = json.load(jsonfile)
                     hour = "{:02d}".format(hour)
-                    relays = data[hour]
-                    for item in relays:
-                        control = "{}.on()".format(item)
-                        exec(control)
-                        print("           Failsafe-mode: {} on".format(item))
+                    for item in data[hour]:
+                        i = relayBank.index(item)
+                        if i is None:
+                            print("           Failsafe-mode: unknown relay {}".format(item))
+                        else:
+                            relayBank.set(i, 1)
+                            print("           Failsafe-mode: {} on".format(item))
                 
                 # Set RGB to cyan
                 np[0] = (0, 255, 255)
@@ -389,19 +467,41 @@ def doControls(timerInitiated):
             # Set RGB to white
             np[0] = (0, 0, 0)
             np.write()
-            channels = int(controlsJson['Metadata']['Channels'])
             i = 0
-            while i < channels:
-                relays[i].off()
-                print("           Relay {}:".format(i + 1), relays[i].value())
+            while i < len(relayBank):
+                relayBank.set(i, 0)
+                print("           Relay {}:".format(i + 1), relayBank.value(i))
                 i += 1
         
         return False
 
 
+# Arm control timer for the next moment when relay states change. Timer is re-planned
+# after each control and when new JSON arrives, so there is no need to poll schedule.
+def planControls():
+    controlTimer.deinit()
+    
+    if not rtcSynced:
+        return
+    
+    toNextControl = secondsUntilNextControl()
+    if toNextControl is None:
+        time = rtc.datetime()
+        print("[{:02d}:{:02d}:{:02d}]".format(time[4],time[5],time[6]),end=" ")
+        print('No upcoming relay changes, control timer not set')
+        return
+    
+    time = rtc.datetime()
+    print("[{:02d}:{:02d}:{:02d}]".format(time[4],time[5],time[6]),end=" ")
+    print('Set relay control timer ({} seconds)'.format(toNextControl))
+    
+    # Fire a second after the change so the RTC is surely on the new quarter
+    controlTimer.init(mode=Timer.ONE_SHOT, period=(toNextControl + 1) * 1000, callback=doControlsTimer)
+
 # Timer functions        
 def doControlsTimer(Timer):
     doControls(True)
+    planControls()
     
 def getControlsTimer(Timer):
     global getControlsTimerArmed
@@ -417,15 +517,30 @@ def runProgram(Timer):
     # Get controls if RTC not synced. Makes initial JSON-request happen faster.
     if not rtcSynced:
         getControls()
+        
+        # If request failed but there is cached schedule, sync RTC from NTP to be able to use it
+        if not rtcSynced and controlSchedule and connectionmanager.wlan_sta.isconnected():
+            if syncClockNtp():
+                doControls(False)
+                planControls()
     
     # Update state
     updateStatus()
+    
+    # Write changed persistent data to flash
+    try:
+        scheduleStore.flush()
+    except OSError as e:
+        consoleLog("Could not write schedule cache: {}".format(e))
         
 
     #If getControls timer not armed -> arm. Set timer also when out of connection to try periodically if connection becomes established
     if not getControlsTimerArmed:
-        #Set new random interval for timer: 90 sec + random 0-30 sec
-        requestInterval = random.randrange(30) + 90
+        # Plan next request by schedule validity and last server responses
+        validUntil = None
+        if controlSchedule and rtcSynced:
+            validUntil = controlSchedule.validUntil() - 3600
+        requestInterval = pollPlanner.next(validUntil, mktime(localtime()))
         
         time = rtc.datetime() 
         print("[{:02d}:{:02d}:{:02d}]".format(time[4],time[5],time[6]),end=" ")
@@ -437,6 +552,42 @@ def runProgram(Timer):
         getControlsTimerArmed = True
 
 # Helper functions
+def updateHoursLeft():
+    global hoursLeftOnJson
+    timeUnix = mktime(localtime())
+    hoursLeftOnJson = floor((controlSchedule.validUntil() - timeUnix) / 3600)
+
+# Seconds until relay states change next time, None if nothing is going to change
+def secondsUntilNextControl():
+    time = rtc.datetime()
+    toNextHour = 3600 - time[5] * 60 - time[6]
+    
+    if controlSchedule and hoursLeftOnJson > 0:
+        # JSON expires when there is less than an hour left, after that failsafe is used
+        timeUnix = mktime(localtime())
+        toExpiry = controlSchedule.validUntil() - 3600 - timeUnix + 1
+        
+        # Find the first quarter when any of the channels changes state
+        currentSlot = schedule.slot(time[4], time[5])
+        toNextSlot = schedule.SLOT_SECONDS - (time[5] % 15) * 60 - time[6]
+        channels = min(controlSchedule.channels, len(relayBank))
+        for n in range(1, schedule.SLOTS_PER_DAY):
+            toChange = toNextSlot + (n - 1) * schedule.SLOT_SECONDS
+            if toChange >= toExpiry:
+                break
+            slot = (currentSlot + n) % schedule.SLOTS_PER_DAY
+            for i in range(channels):
+                result = controlSchedule.get(i, slot)
+                if result is not None and result != relayBank.value(i):
+                    return toChange
+        return max(toExpiry, 0)
+    
+    # Failsafe-schedule changes hourly, without failsafe relays are just kept off
+    elif failsafe:
+        return toNextHour
+    
+    return None
+
 def secondsUntilNextQuarter():
     time = rtc.datetime()
     minute = time[5]
@@ -476,68 +627,299 @@ def syncClock(t,diff):
         bootTimestampSynced = True
     
     return rtcSynced
+
+# NTP time is counted from the device epoch (2000 on rp2 firmware), but RTC is kept in Unix
+# time like the server timestamps. Cached schedule is used only if NTP time is inside it.
+def syncClockNtp():
+    global rtcSynced
+    try:
+        import ntptime
+        unixTime = ntptime.time() + (946684800 if gmtime(0)[0] == 2000 else 0)
+    except Exception as e:
+        consoleLog("Could not sync RTC from NTP: {}".format(e))
+        return rtcSynced
+    
+    timeWithOffset = unixTime + controlSchedule.timestampOffset
+    if not controlSchedule.timestamp + controlSchedule.timestampOffset <= timeWithOffset < controlSchedule.validUntil():
+        consoleLog("NTP time is outside cached schedule, RTC not synced")
+        return rtcSynced
+    consoleLog("RTC synced from NTP")
+    rtcSynced = syncClock(timeWithOffset, timeWithOffset - mktime(localtime()))
+    return rtcSynced
+
+def uptimeSeconds():
+    return mktime(localtime()) - bootTimestamp
+
+def fileEtag(fileName):
+    # ETag is crc32 of the file, calculated in small pieces
+    crc = 0
+    buffer = bytearray(256)
+    with open(fileName, 'rb') as file:
+        while True:
+            n = file.readinto(buffer)
+            if not n:
+                break
+            crc = crc32(memoryview(buffer)[:n], crc)
+    return '"{:08x}"'.format(crc)
+
+def consoleLog(message):
+    time = rtc.datetime()
+    print("[{:02d}:{:02d}:{:02d}]".format(time[4],time[5],time[6]),end=" ")
+    print(message)
+
+def connectionChanged(oldState, newState):
+    consoleLog("Wifi: {} -> {}".format(connectionmanager.STATE_NAMES[oldState], connectionmanager.STATE_NAMES[newState]))
            
     
 # Start the program
 # RTC is probably not yet in time, but we save timestamp here and add add diff once time is synced
 bootTimestamp = mktime(localtime())
 
+# Connect wifi in background, relays are controlled from cached schedule meanwhile
+connectionmanager.add_listener(connectionChanged)
+connectionmanager.start(profiles)
+
+# Load last schedule from flash, so relays can be controlled before the first request succeeds.
+# If RTC has kept its time over the reboot, cached schedule is used right away.
+scheduleStore = storage.Storage('schedule', storageFlushInterval)
+try:
+    if scheduleStore.data:
+        controlSchedule = schedule.unpack(scheduleStore.data)
+        consoleLog("Loaded cached schedule")
+        timeUnix = mktime(localtime())
+        if controlSchedule.timestamp + controlSchedule.timestampOffset <= timeUnix < controlSchedule.validUntil():
+            rtcSynced = True
+            doControls(False)
+            planControls()
+except ValueError as e:
+    print("Could not load cached schedule: {}".format(e))
+
+# Static files served from flash (path: file, content type). If there is also gzipped
+# version of the file (eg. style.css.gz), it is served to browsers which accept gzip.
+# Gzipped version has its own ETag, so the two versions are never mixed up in caches.
+staticAssets = {}
+for path, fileName, contentType in (('/style.css', 'style.css', 'text/css'),):
+    try:
+        try:
+            gzipEtag = fileEtag(fileName + '.gz')
+        except OSError:
+            gzipEtag = None
+        staticAssets[path] = (fileName, contentType, fileEtag(fileName), gzipEtag)
+    except OSError:
+        print("Static file {} not found".format(fileName))
+
 # Start program loop timer
 programTimer.init(mode=Timer.PERIODIC, period = 30 * 1000, callback=runProgram)
 
-# HTTP-server for info and managing settings, known bug, needs to be rewritten into function to reset socket state when wifi changes
-if connectionmanager.wlan_sta:
-    ip = connectionmanager.wlan_sta.ifconfig()[0]
-else:
-    ip = '0.0.0.0'
-
-addr = socket.getaddrinfo(ip, 80)[0][-1]
-s = socket.socket()
-s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-s.bind(addr)
-s.listen(5)
-
-while True:
-    cl, addr = s.accept()
-    cl_file = cl.makefile('rwb', 0)
-    time = rtc.datetime() 
-    print("\n[{:02d}:{:02d}:{:02d}]".format(time[4],time[5],time[6]),end=" ")
-    print("Client connected, ip: {}".format(addr[0]))
-    while True:
-        line = cl_file.readline()
-        if not line or line == b'\r\n':
-            break
+# HTTP-server for info and managing settings. Server runs as uasyncio task so a slow client can't block
+# other clients, and listening socket is re-bound when connection changes between wifi and access point.
+def serverAddress():
+    if connectionmanager.wlan_sta.isconnected():
+        return connectionmanager.wlan_sta.ifconfig()[0]
+    elif connectionmanager.wlan_ap.active():
+        return connectionmanager.wlan_ap.ifconfig()[0]
+    else:
+        return '0.0.0.0'
+
+# Page fragments are gathered into a buffer and written to client when buffer is full, so
+# a page takes a few drains instead of one for every table cell
+async def sendPage(writer, page):
+    buffer = bytearray(serverPageBuffer)
+    view = memoryview(buffer)
+    n = 0
+    for fragment in page:
+        data = fragment.encode()
+        if n + len(data) > serverPageBuffer:
+            writer.write(view[:n])
+            await asyncio.wait_for(writer.drain(), serverTimeout)
+            n = 0
+        if len(data) >= serverPageBuffer:
+            writer.write(data)
+            await asyncio.wait_for(writer.drain(), serverTimeout)
+        else:
+            view[n:n + len(data)] = data
+            n += len(data)
+    if n:
+        writer.write(view[:n])
+        await asyncio.wait_for(writer.drain(), serverTimeout)
+
+async def sendFrontpage(writer):
     time = rtc.datetime()
-    uptimeUnix = mktime(localtime()) - bootTimestamp
+    uptimeUnix = uptimeSeconds()
     upMinutes, upSeconds = divmod(uptimeUnix, 60)
     upHours, upMinutes = divmod(upMinutes, 60)
     upDays, upHours = divmod(upHours, 24)
     uptime = "{} days, {:02d} hours, {:02d} minutes, {:02d} seconds".format(upDays,upHours,upMinutes,upSeconds)
-    if controlsJson:
-        if connectionmanager.wlan_ap.isconnected():
-            ip = '192.168.4.1'
-        else:
-            ip = connectionmanager.wlan_sta.ifconfig()[0]
-        
-        response = webpages.frontpage_with_json(controlsJson,relays,time,uptime,mac,ip)
-            
+    ip = serverAddress()
+    if controlSchedule:
+        page = webpages.frontpage_with_json(controlSchedule,relays,time,uptime,mac,ip)
     else:
-        if connectionmanager.wlan_ap.isconnected():
-            ip = '192.168.4.1'
-        else:
-            ip = connectionmanager.wlan_sta.ifconfig()[0]
-            
-        response = webpages.frontpage_without_json(time,uptime,mac,ip)
+        page = webpages.frontpage_without_json(time,uptime,mac,ip)
+    
+    # Page is streamed to client fragment by fragment (HTTP/1.0, end of body is marked by closing connection)
+    writer.write('HTTP/1.0 200 OK\r\nContent-type: text/html\r\n\r\n')
+    await sendPage(writer, page)
+
+# JSON API for monitoring devices without parsing the dashboard
+def apiStatus():
+    return {
+        'mac': mac,
+        'version': VERSION,
+        'uptime': uptimeSeconds(),
+        'rtc_synced': rtcSynced,
+        'hours_left': hoursLeftOnJson,
+        'last_request': lastRequest,
+        'last_request_code': lastRequestCode,
+        'mem_free': gc.mem_free(),
+        'mem_alloc': gc.mem_alloc(),
+        'flash_writes': scheduleStore.writes,
+        'relays': [relay.value() for relay in relays],
+        'wifi': connectionmanager.telemetry()
+    }
+
+def apiSchedule():
+    if not controlSchedule:
+        return {'channels': 0, 'schedule': []}
+    
+    # Schedule as list of quarter-hour states (index = slot of the day) for each channel, None if slot is missing
+    channels = []
+    for i in range(controlSchedule.channels):
+        channels.append([controlSchedule.get(i, slot) for slot in range(schedule.SLOTS_PER_DAY)])
+    return {
+        'channels': controlSchedule.channels,
+        'resolution': schedule.SLOT_SECONDS // 60,
+        'timestamp': controlSchedule.timestamp,
+        'hours_count': controlSchedule.hoursCount,
+        'schedule': channels
+    }
+
+async def sendJson(writer, document):
+    writer.write('HTTP/1.0 200 OK\r\nContent-Type: application/json\r\nCache-Control: no-cache\r\n\r\n')
+    writer.write(json.dumps(document))
+    await asyncio.wait_for(writer.drain(), serverTimeout)
+
+async def sendStatic(writer, asset, headers):
+    fileName, contentType, etag, gzipEtag = asset
+    
+    encoding = ''
+    if gzipEtag and 'gzip' in headers.get('accept-encoding', ''):
+        fileName = fileName + '.gz'
+        etag = gzipEtag
+        encoding = 'Content-Encoding: gzip\r\n'
+    
+    # Browser has current version cached already
+    if etag and headers.get('if-none-match') == etag:
+        writer.write('HTTP/1.0 304 Not Modified\r\nETag: {}\r\nVary: Accept-Encoding\r\nCache-Control: max-age={}\r\n\r\n'.format(etag,serverStaticMaxAge))
+        await asyncio.wait_for(writer.drain(), serverTimeout)
+        return
+    
+    writer.write('HTTP/1.0 200 OK\r\nContent-Type: {}\r\nContent-Length: {}\r\n{}Vary: Accept-Encoding\r\nETag: {}\r\nCache-Control: max-age={}\r\n\r\n'.format(contentType,os.stat(fileName)[6],encoding,etag,serverStaticMaxAge))
+    
+    # Send file from flash in small pieces
+    buffer = bytearray(256)
+    with open(fileName, 'rb') as file:
+        while True:
+            n = file.readinto(buffer)
+            if not n:
+                break
+            writer.write(memoryview(buffer)[:n])
+            await asyncio.wait_for(writer.drain(), serverTimeout)
+
+async def serveClient(reader, writer):
+    global serverClients
+    
+    addr = writer.get_extra_info('peername')
+    
+    # Refuse connection if there are already too many clients served
+    if serverClients >= serverMaxClients:
+        consoleLog("Too many clients, refusing connection from ip: {}".format(addr[0]))
+        try:
+            writer.write(b'HTTP/1.0 503 Service Unavailable\r\nRetry-After: 5\r\n\r\n')
+            await asyncio.wait_for(writer.drain(), serverTimeout)
+        except:
+            pass
+        writer.close()
+        return
+    
+    serverClients += 1
+    consoleLog("Client connected, ip: {}".format(addr[0]))
+    try:
+        # Read request line and headers. Slow or half-open connections are dropped after timeout.
+        # Only headers needed by the server are kept.
+        line = await asyncio.wait_for(reader.readline(), serverTimeout)
+        try:
+            path = line.split()[1].decode().split('?')[0]
+        except:
+            path = '/'
+        headers = {}
+        while True:
+            line = await asyncio.wait_for(reader.readline(), serverTimeout)
+            if not line or line == b'\r\n':
+                break
+            name, _, value = line.decode().partition(':')
+            name = name.strip().lower()
+            if name in ('if-none-match', 'accept-encoding'):
+                headers[name] = value.strip()
         
+        if path in staticAssets:
+            await sendStatic(writer, staticAssets[path], headers)
+        elif path == '/api/status':
+            await sendJson(writer, apiStatus())
+        elif path == '/api/schedule':
+            await sendJson(writer, apiSchedule())
+        else:
+            await sendFrontpage(writer)
         
-   
-    cl.send('HTTP/1.0 200 OK\r\nContent-type: text/html\r\n\r\n')
-    cl.sendall(response)
-    cl.close()
-    time = rtc.datetime() 
-    print("\n[{:02d}:{:02d}:{:02d}]".format(time[4],time[5],time[6]),end=" ")
-    print("Client disconnected")
+    except asyncio.TimeoutError:
+        consoleLog("Client timed out, ip: {}".format(addr[0]))
+    except OSError as e:
+        consoleLog("Client connection error: {}".format(e))
+    finally:
+        serverClients -= 1
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+        consoleLog("Client disconnected, ip: {}".format(addr[0]))
+
+async def runServer():
+    server = None
+    serverAddresses = None
+    
+    # Server listens on all interfaces (wifi and access point can be up at the same time).
+    # Check periodically if addresses have changed and re-bind server.
+    while True:
+        addresses = connectionmanager.addresses()
+        if addresses != serverAddresses:
+            if server:
+                consoleLog("Connection changed, closing web server on {}".format(', '.join(serverAddresses)))
+                server.close()
+                await server.wait_closed()
+                server = None
+                serverAddresses = None
+            try:
+                server = await asyncio.start_server(serveClient, '0.0.0.0', serverPort, backlog=5)
+                serverAddresses = addresses
+                consoleLog("Web server listening on {} port {}".format(', '.join(addresses), serverPort))
+            except OSError as e:
+                consoleLog("Could not start web server: {}".format(e))
+        await asyncio.sleep(serverCheckInterval)
+
+# Advance wifi connection state machine, ticks are frequent only while connecting
+async def runConnection():
+    while True:
+        connectionmanager.tick()
+        await asyncio.sleep(connectionmanager.tick_interval() / 1000)
+
+async def runTasks():
+    asyncio.create_task(runConnection())
+    await runServer()
 
+try:
+    asyncio.run(runTasks())
+except Exception as e:
+    print("Web server stopped: {}".format(e))
 
 # Shouldn't get here from server loop. If something goes wrong, then reboot machine.
 machine.reset()
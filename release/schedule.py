@@ -0,0 +1,137 @@
+# Control schedule stored as bitmaps. Day is divided into 96 quarter-hour slots and each
+# channel has one bit per slot, so schedule takes 12 bytes per channel. Hourly schedules
+# are expanded to four quarter slots. Another bitmap tells which slots were present in JSON.
+# Metadata fields used by the client are kept as attributes, rest of the JSON is discarded.
+
+try:
+    import ustruct as struct
+except:
+    import struct
+
+SLOTS_PER_DAY = 96
+SLOT_SECONDS = 900
+BYTES_PER_CHANNEL = SLOTS_PER_DAY // 8
+
+class Schedule:
+    def __init__(self, channels):
+        self.channels = channels
+        self.states = bytearray(channels * BYTES_PER_CHANNEL)
+        self.known = bytearray(channels * BYTES_PER_CHANNEL)
+        self.timestamp = 0
+        self.timestampOffset = 0
+        self.hoursCount = 0
+        self.fetchUrl = None
+
+    def set(self, channel, slot, state):
+        i = channel * BYTES_PER_CHANNEL + (slot >> 3)
+        bit = 1 << (slot & 7)
+        self.known[i] |= bit
+        if state:
+            self.states[i] |= bit
+        else:
+            self.states[i] &= ~bit
+
+    # State of channel (index from 0) in slot, None if slot was missing from JSON
+    def get(self, channel, slot):
+        i = channel * BYTES_PER_CHANNEL + (slot >> 3)
+        bit = 1 << (slot & 7)
+        if not self.known[i] & bit:
+            return None
+        return 1 if self.states[i] & bit else 0
+
+    # Local time when schedule ends
+    def validUntil(self):
+        return self.timestamp + self.timestampOffset + self.hoursCount * 3600
+
+
+# Slot of the day for given time
+def slot(hour, minute):
+    return hour * 4 + minute // 15
+
+# Builds schedule from values streamed by jsonstream parser. Metadata may come before or after
+# channel data, so states are first collected by key (hour/slot index, or time of day for
+# "HH:MM" keys) and expanded to slots by resolution when the whole response has been read.
+class ScheduleBuilder:
+    def __init__(self, maxChannels):
+        self.maxChannels = maxChannels
+        self.keyed = Schedule(maxChannels)
+        self.timed = Schedule(maxChannels)
+        self.metadata = {}
+
+    # Handler for jsonstream, path is [group, key]
+    def value(self, path, value):
+        if len(path) != 2:
+            return
+        group, key = path
+        if group == 'Metadata':
+            self.metadata[key] = value
+        elif group.startswith('Channel'):
+            # Other keys starting with Channel (eg. Channel_names) are not channel data
+            if not group[7:].isdigit():
+                return
+            channel = int(group[7:]) - 1
+            if channel < 0 or channel >= self.maxChannels:
+                return
+            state = 1 if str(value) == '1' else 0
+            if ':' in key:
+                hour, minute = key.split(':')
+                self.timed.set(channel, slot(int(hour), int(minute)) % SLOTS_PER_DAY, state)
+            else:
+                self.keyed.set(channel, int(key) % SLOTS_PER_DAY, state)
+
+    def finish(self):
+        metadata = self.metadata
+        channels = int(metadata['Channels'])
+        resolution = int(metadata.get('Resolution', 60))
+        slotsPerKey = max(resolution // 15, 1)
+        
+        controlSchedule = Schedule(channels)
+        controlSchedule.timestamp = int(metadata['Timestamp'])
+        controlSchedule.timestampOffset = int(metadata['Timestamp_offset'])
+        controlSchedule.hoursCount = int(metadata['Hours_count'])
+        controlSchedule.fetchUrl = metadata.get('Fetch_url')
+        
+        for i in range(min(channels, self.maxChannels)):
+            for key in range(SLOTS_PER_DAY):
+                state = self.keyed.get(i, key)
+                if state is not None:
+                    first = key * slotsPerKey
+                    for n in range(first, first + slotsPerKey):
+                        controlSchedule.set(i, n % SLOTS_PER_DAY, state)
+                state = self.timed.get(i, key)
+                if state is not None:
+                    for n in range(key, key + slotsPerKey):
+                        controlSchedule.set(i, n % SLOTS_PER_DAY, state)
+        return controlSchedule
+
+
+# Schedule in binary form for the flash cache: header (magic, channels, timestamp, timestamp
+# offset, hours count, fetch url length), fetch url and the state and known bitmaps.
+CACHE_HEADER = '<4sBIiHH'
+CACHE_MAGIC = b'PSC1'
+
+def pack(controlSchedule):
+    fetchUrl = (controlSchedule.fetchUrl or '').encode()
+    header = struct.pack(CACHE_HEADER, CACHE_MAGIC, controlSchedule.channels, controlSchedule.timestamp, controlSchedule.timestampOffset, controlSchedule.hoursCount, len(fetchUrl))
+    return header + fetchUrl + controlSchedule.states + controlSchedule.known
+
+# Raises ValueError if data is not a valid schedule
+def unpack(data):
+    headerSize = struct.calcsize(CACHE_HEADER)
+    if len(data) < headerSize:
+        raise ValueError('Schedule cache: truncated header')
+    magic, channels, timestamp, timestampOffset, hoursCount, urlLength = struct.unpack(CACHE_HEADER, data[:headerSize])
+    if magic != CACHE_MAGIC:
+        raise ValueError('Schedule cache: unknown format')
+    controlSchedule = Schedule(channels)
+    bitmapSize = len(controlSchedule.states)
+    start = headerSize + urlLength
+    if len(data) != start + 2 * bitmapSize:
+        raise ValueError('Schedule cache: wrong size')
+    controlSchedule.states[:] = data[start:start + bitmapSize]
+    controlSchedule.known[:] = data[start + bitmapSize:]
+    controlSchedule.timestamp = timestamp
+    controlSchedule.timestampOffset = timestampOffset
+    controlSchedule.hoursCount = hoursCount
+    controlSchedule.fetchUrl = data[headerSize:start].decode() or None
+    return controlSchedule